@@ -1,3 +1,5 @@
+import os
+
 class Assignment:
 
     #TODO -- this has state now, so we need to make sure not overwritten by synchronize
@@ -24,6 +26,13 @@ class Assignment:
     def grader_basename(self):
         return ''.join(ch for ch in self.name if ch.isalnum())+'-grader-'
 
+    def init_grader_workloads(self, grader_folder_root):
+        # if the grader workload dict hasn't been created yet, create it with every grader account for this assignment
+        if len(self.grader_workloads) == 0:
+            graders = [username.strip('/') for username in os.listdir(grader_folder_root) if self.grader_basename() in username]
+            for grd in graders:
+                self.grader_workloads[grd] = 0
+
     def get_due_date(self, s):
         basic_date = self.due_at
 
@@ -46,6 +55,20 @@ class Assignment:
         else:
             return basic_date, None
 
+    def get_unlock_date(self, s):
+        #the student's effective unlock date: the earliest of the basic and the student's override unlock dates
+        #returns None if it can't be established (no basic unlock date, or an override for the student without one)
+        if self.unlock_at is None:
+            return None
+        unlock_date = self.unlock_at
+        for over in self.overrides:
+            if s.canvas_id in over['student_ids']:
+                if over.get('unlock_at') is None:
+                    return None
+                if over['unlock_at'] < unlock_date:
+                    unlock_date = over['unlock_at']
+        return unlock_date
+
         #self.all_submissions=[]
         #self.client = docker.from_env()
         #self.container = client.containers.get('45e6d2de7c54') #TODO what container?
@@ -1,7 +1,20 @@
 import requests
 import urllib.parse
+import os
+import json
+import time
 import pendulum as plm
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from .httpcache import HTTPCache
+from .throttle import Throttle
+
+#canvas dates repeat a lot (e.g. overrides usually share their assignment's unlock/lock dates),
+#so memoize parsing; pendulum datetimes are immutable so sharing the parsed objects is safe
+@lru_cache(maxsize=4096)
+def parse_date(date_str):
+    return None if date_str is None else plm.parse(date_str)
 
 class CanvasGetError(Exception):
     def __init__(self, url, resp):
@@ -40,88 +53,204 @@ class Canvas(object):
     Interface to the Canvas REST API
     """
 
-    def __init__(self, config, dry_run):
+    #the only fields of each canvas object that rudaux uses; everything else is dropped as soon as a page is decoded
+    enrollment_fields = ['id', 'type', 'enrollment_state', 'created_at', 'updated_at', 'user']
+    assignment_fields = ['id', 'name', 'due_at', 'lock_at', 'unlock_at', 'points_possible', 'grading_type', 'workflow_state',
+                         'has_overrides', 'overrides', 'published', 'updated_at', 'omit_from_final_grade', 'external_tool_tag_attributes']
+    submission_fields = ['assignment_id', 'user_id', 'grade', 'score', 'workflow_state', 'excused', 'late_policy_status',
+                         'points_deducted', 'posted_at', 'late', 'missing', 'entered_grade', 'entered_score']
+
+    def __init__(self, config, dry_run, course_dir, state):
         self.group_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/groups/')
         self.base_url = urllib.parse.urljoin(config.canvas_domain, 'api/v1/courses/'+config.canvas_id+'/')
         self.token = config.canvas_token
         self.jupyterhub_host_root = config.jupyterhub_host_root
         self.dry_run = dry_run
+        #a single pooled session shared by all requests (avoids a new TCP+TLS handshake per page)
+        #max_workers bounds both the number of pages fetched concurrently and the connection pool size
+        self.max_workers = config.get('canvas_max_workers', 8)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+                    'Authorization': f'Bearer {self.token}',
+                    'Accept': 'application/json'
+                    })
+        #all requests go through the throttle, which adapts concurrency/pacing to the rate limit budget and retries failures
+        self.throttle = Throttle(self.max_workers, config.get('canvas_max_retries', 5))
+        #persistent course state (see state.py); holds the delta sync state below and the cached group memberships,
+        #so that unchanged groups don't need a memberships request per group
+        self.state = state
+        self.group_cache_max_age = config.get('group_cache_max_age_hours', 24)
+        #on-disk http cache; GETs send the stored ETag/Last-Modified so unchanged resources come back as 304s
+        self.http_cache = None
+        if config.get('canvas_http_cache', True):
+            self.http_cache = HTTPCache(os.path.join(course_dir, config.name + '_http_cache'),
+                                        config.get('canvas_http_cache_max_mb', 200),
+                                        config.get('canvas_http_cache_max_age_days', 7))
+            self.http_cache.evict()
+        #delta sync: processed entities are kept in the state database keyed by canvas id along with what they were built from,
+        #so unchanged enrollments/assignments aren't reprocessed and settled submissions are only fetched if changed
+        self.delta_sync = config.get('canvas_delta_sync', True)
 
     #cache subsequent calls to avoid slow repeated access to canvas api
     #@lru_cache(maxsize=None) TODO -- be careful, e.g., get_overrides overwrites the dict return, which is cached
     #so when you call get again it breaks things
     #disabling the cache for now. In the future should call cache_clear() when certain get functions are called.
     #also sometimes we need to force no cache when synchronizing (after various updates)
-    def get(self, path_suffix, use_group_base=False):
+    def get(self, path_suffix, use_group_base=False, params=None, fields=None):
+        return list(self.iter_get(path_suffix, use_group_base, params, fields))
+
+    def iter_get(self, path_suffix, use_group_base=False, params=None, fields=None):
+        #yield the items of a (possibly paginated) canvas collection page by page, in page order,
+        #so callers can process/filter items without holding the whole collection in memory
+        #if fields is specified, each item is cut down to only those (top level) keys as soon as its page is decoded
         if use_group_base:
             url = urllib.parse.urljoin(self.group_url, path_suffix)
         else:
             url = urllib.parse.urljoin(self.base_url, path_suffix)
-        resp = None
-        resp_items = []
+        #extra params only need to be sent with the first page; canvas carries them through in the Link header urls
+        json_data, links = self._get_page(url, params, fields, need_links = True)
+        yield from self._page_items(json_data)
+
+        #if canvas tells us where the last page is, fetch the remaining pages concurrently
+        #(keeping at most max_workers pages in flight); otherwise (e.g. bookmark-style pagination)
+        #follow the next links one at a time
+        page_urls = self._remaining_page_urls(links)
+        if page_urls is not None:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = deque()
+                for page_url in page_urls:
+                    pending.append(executor.submit(self._get_page, page_url, None, fields))
+                    if len(pending) >= self.max_workers:
+                        yield from self._page_items(pending.popleft().result()[0])
+                while len(pending) > 0:
+                    yield from self._page_items(pending.popleft().result()[0])
+        else:
+            while 'next' in links.keys():
+                json_data, links = self._get_page(links['next']['url'], None, fields, need_links = True)
+                yield from self._page_items(json_data)
+
+    def _get_page(self, url, params=None, fields=None, need_links=False):
         #see https://community.canvaslms.com/t5/Question-Forum/Why-is-the-Assignment-due-at-value-that-of-the-last-override/m-p/209593
         #for why we have to set override_assignment_dates = false below -- basically due_at below gets set really weirdly if
         #the assignment has overrides unless you include this param
-        while resp is None or 'next' in resp.links.keys():
-            resp = requests.get(
-                url = url if resp is None else resp.links['next']['url'],
-                headers = {
-                    'Authorization': f'Bearer {self.token}',
-                    'Accept': 'application/json'
-                    },
-                json = {'per_page' : 100},
-                params = {'override_assignment_dates' : False}
-            )
-
-            if resp.status_code < 200 or resp.status_code > 299:
-                raise CanvasGetError(url, resp)
-
-            json_data = resp.json()
-            if isinstance(json_data, list):
-                resp_items.extend(resp.json())
-            else:
-                resp_items.append(resp.json())
-
-        return resp_items
-
-    def upload(self, path_suffix, json_data, typ):
-        rfuncs = {'put' : requests.put,
-                 'post': requests.post,
-                 'delete': requests.delete}
+        #returns the decoded json and the pagination links for a single page
+        #the Link header isn't part of what the ETag covers, so a cached page's links may be stale (e.g. the old last page,
+        #before the collection grew); if the caller needs the links of a collection page (need_links), it isn't requested conditionally
+        req_params = {'override_assignment_dates' : False}
+        if params is not None:
+            req_params.update(params)
+
+        cache_key = None
+        entry = None
+        if self.http_cache is not None:
+            cache_key = url + '?' + urllib.parse.urlencode(sorted(req_params.items()), doseq=True) + ('' if fields is None else '#' + ','.join(fields))
+            entry = self.http_cache.get(cache_key)
+            if need_links and entry is not None and isinstance(entry['data'], list):
+                entry = None
+
+        resp = self.throttle.request(self.session.get,
+            url = url,
+            headers = self.http_cache.headers(entry) if self.http_cache is not None else None,
+            json = {'per_page' : 100},
+            params = req_params
+        )
+
+        #not modified since we cached it; skip downloading and decoding the body
+        if resp.status_code == 304 and entry is not None:
+            self.http_cache.touch(cache_key)
+            return entry['data'], entry['links']
+
+        if resp.status_code < 200 or resp.status_code > 299:
+            raise CanvasGetError(url, resp)
+        json_data = resp.json()
+        if fields is not None:
+            json_data = [self._project(item, fields) for item in json_data] if isinstance(json_data, list) else self._project(json_data, fields)
+
+        if cache_key is not None and (resp.headers.get('ETag') is not None or resp.headers.get('Last-Modified') is not None):
+            self.http_cache.put(cache_key, {'etag' : resp.headers.get('ETag'),
+                                            'last_modified' : resp.headers.get('Last-Modified'),
+                                            'data' : json_data,
+                                            'links' : resp.links})
+        return json_data, resp.links
+
+    def _project(self, item, fields):
+        return {key : item[key] for key in fields if key in item}
+
+    def _page_items(self, json_data):
+        return json_data if isinstance(json_data, list) else [json_data]
+
+    def _remaining_page_urls(self, links):
+        #build the urls for pages next..last from the Link header, or return None if
+        #the pages aren't numbered (canvas sometimes uses opaque bookmarks)
+        if 'next' not in links.keys() or 'last' not in links.keys():
+            return None
+        next_url = links['next']['url']
+        last_url = links['last']['url']
+        parsed = urllib.parse.urlparse(next_url)
+        query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+        try:
+            next_page = int(query['page'][0])
+            last_page = int(urllib.parse.parse_qs(urllib.parse.urlparse(last_url).query)['page'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+        page_urls = []
+        for page in range(next_page, last_page+1):
+            query['page'] = [str(page)]
+            page_urls.append(urllib.parse.urlunparse(parsed._replace(query=urllib.parse.urlencode(query, doseq=True))))
+        return page_urls
+
+    def upload(self, path_suffix, json_data, typ, safe = False):
+        rfuncs = {'put' : self.session.put,
+                 'post': self.session.post,
+                 'delete': self.session.delete}
         url = urllib.parse.urljoin(self.base_url, path_suffix)
         if not self.dry_run:
-            resp = rfuncs[typ](
+            #puts and deletes are idempotent, so they can be retried; posts only if the caller says it's safe
+            resp = self.throttle.request(rfuncs[typ], retry = (typ != 'post' or safe),
                 url = url,
-                headers = {
-                    'Authorization': f'Bearer {self.token}',
-                    'Accept': 'application/json'
-                    },
                 json=json_data
             )
             if resp.status_code < 200 or resp.status_code > 299:
                 print('Canvas Upload Error: ' + str(resp.reason))
                 raise CanvasUploadError(url, resp, typ)
+            #some endpoints (e.g. bulk grading) return an object we need to inspect
+            return resp.json() if len(resp.content) > 0 else None
         else:
             print('[Dry Run: would have made a ' + typ + ' request with URL: ' + url + ']')
         return
          
 
     def put(self, path_suffix, json_data):
-        self.upload(path_suffix, json_data, 'put')
+        return self.upload(path_suffix, json_data, 'put')
 
-    def post(self, path_suffix, json_data):
-        self.upload(path_suffix, json_data, 'post')
+    def post(self, path_suffix, json_data, safe = False):
+        return self.upload(path_suffix, json_data, 'post', safe)
 
     def delete(self, path_suffix):
-        self.upload(path_suffix, None, 'delete')
+        return self.upload(path_suffix, None, 'delete')
 
     def get_course_info(self):
         return self.get('')[0]
 
-    def _get_people_by_type(self, typ):
-        people = self.get('enrollments')
-        ppl_typ = [p for p in people if p['type'] == typ]
-        return [ { 'name' : p['user']['name'],
+    def get_people(self, types=None):
+        #download the enrollments once and partition them by enrollment type
+        #if types is specified, only those types are requested from canvas (and returned)
+        people = {typ : [] for typ in types} if types is not None else {}
+        cached = self.state.load_canvas_delta('enrollments') if self.delta_sync else {}
+        changed = {}
+        for p in self._iter_enrollments(types):
+            if types is not None and p['type'] not in people:
+                continue
+            #reuse the processed enrollment if it hasn't been updated since the last sync
+            key = str(p['id'])
+            if self.delta_sync and key in cached and cached[key][0] == p['updated_at']:
+                person = cached[key][1]
+            else:
+                person = {
+                   'name' : p['user']['name'],
                    'sortable_name' : p['user']['sortable_name'],
                    'short_name' : p['user']['short_name'],
                    'canvas_id' : str(p['user']['id']),
@@ -129,8 +258,21 @@ class Canvas(object):
                    'reg_created' : plm.parse(p['created_at']),
                    'reg_updated' : plm.parse(p['updated_at']),
                    'status' : p['enrollment_state']
-                  } for p in ppl_typ
-               ] 
+                  }
+                changed[key] = (p['updated_at'], person)
+            people.setdefault(p['type'], []).append(person)
+        #only the new/updated enrollments are written back
+        if self.delta_sync:
+            self.state.save_canvas_delta('enrollments', changed)
+        return people
+
+    def _iter_enrollments(self, types):
+        #the raw enrollment objects (subclasses may obtain these differently; see canvas_graphql)
+        params = None if types is None else {'type[]' : types}
+        return self.iter_get('enrollments', params=params, fields=Canvas.enrollment_fields)
+
+    def _get_people_by_type(self, typ):
+        return self.get_people([typ])[typ]
 
     def get_students(self):
         return self._get_people_by_type('StudentEnrollment')
@@ -145,38 +287,144 @@ class Canvas(object):
         return self._get_people_by_type('TaEnrollment')
 
     def get_groups(self):
-        grps = self.get('groups')
+        grps = self.get('groups', fields=['id', 'name', 'members_count'])
+
+        #canvas groups have no updated_at, so key the cached memberships on a fingerprint of the group listing
+        #(which includes members_count); entries are also refreshed once they are older than the max age
+        #to catch membership swaps that don't change the member count
+        cache = self.state.load_canvas_groups()
+        now = plm.now()
+        fingerprints = {str(g['id']) : json.dumps(g, sort_keys=True) for g in grps}
+        stale = [g for g in grps if str(g['id']) not in cache or
+                                    cache[str(g['id'])]['fingerprint'] != fingerprints[str(g['id'])] or
+                                    cache[str(g['id'])]['fetched_at'] + 3600*self.group_cache_max_age < now.timestamp()]
+
+        #fetch all the stale memberships concurrently rather than one group at a time
+        refetched = {}
+        if len(stale) > 0:
+            print('Fetching memberships for ' + str(len(stale)) + ' of ' + str(len(grps)) + ' groups (others cached)')
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                memberships = executor.map(lambda g : self.get(str(g['id'])+'/memberships', use_group_base=True, fields=['user_id']), stale)
+                for g, mems in zip(stale, memberships):
+                    refetched[str(g['id'])] = {'fingerprint' : fingerprints[str(g['id'])],
+                                               'fetched_at' : now.timestamp(),
+                                               'members' : [str(m['user_id']) for m in mems]}
+        cache.update(refetched)
+
+        #only the refetched groups are written back, and groups that no longer exist are dropped from the cache
+        self.state.save_canvas_groups(refetched, [gid for gid in cache if gid not in fingerprints])
+
         return [{
                  'name' : g['name'],
                  'canvas_id' : str(g['id']),
-                 'members' : [str(m['user_id']) for m in self.get(str(g['id'])+'/memberships', use_group_base=True)]
+                 'members' : cache[str(g['id'])]['members']
                 } for g in grps]
 
 
     def get_assignments(self):
-        asgns = self.get('assignments')
-        processed_asgns = [ {  
-                   'canvas_id' : str(a['id']),
+        #include[]=overrides returns the overrides inline with each assignment, so all overrides come back
+        #with the (paginated) assignment list rather than with one request per assignment
+        #assignments whose updated_at and overrides haven't changed since the last sync reuse the processed assignment
+        cached = self.state.load_canvas_delta('assignments') if self.delta_sync else {}
+        changed = {}
+        processed_asgns = []
+        missing = []
+        for a in self.iter_get('assignments', params={'include[]' : ['overrides'], 'exclude_response_fields[]' : ['description', 'rubric']}, fields=Canvas.assignment_fields):
+            if not ('external_tool_tag_attributes' in a.keys() and self.jupyterhub_host_root in a['external_tool_tag_attributes']['url'] and a['omit_from_final_grade'] == False):
+                continue
+            aid = str(a['id'])
+            version = json.dumps([a['updated_at'], a.get('overrides')], sort_keys=True)
+            if self.delta_sync and aid in cached and cached[aid][0] == version:
+                processed_asgns.append(cached[aid][1])
+                continue
+            pa = {  
+                   'canvas_id' : aid,
                    'name' : a['name'],
-                   'due_at' : None if a['due_at'] is None else plm.parse(a['due_at']),
-                   'lock_at' : None if a['lock_at'] is None else plm.parse(a['lock_at']),
-                   'unlock_at' : None if a['unlock_at'] is None else plm.parse(a['unlock_at']),
+                   'due_at' : parse_date(a['due_at']),
+                   'lock_at' : parse_date(a['lock_at']),
+                   'unlock_at' : parse_date(a['unlock_at']),
                    'points_possible' : a['points_possible'],
                    'grading_type' : a['grading_type'],
                    'workflow_state' : a['workflow_state'],
                    'has_overrides' : a['has_overrides'],
-                   'overrides' : [],
+                   'overrides' : [self._process_override(over) for over in a.get('overrides', [])],
                    'published' : a['published']
-                 } for a in asgns if 'external_tool_tag_attributes' in a.keys() and self.jupyterhub_host_root in a['external_tool_tag_attributes']['url'] and a['omit_from_final_grade'] == False]
-        for a in processed_asgns:
-            if a['has_overrides']:
-                a['overrides'] = self.get_overrides(a['canvas_id'])
-
+                 }
+            changed[aid] = (version, pa)
+            processed_asgns.append(pa)
+            if pa['has_overrides'] and 'overrides' not in a:
+                missing.append(pa)
+
+        #if canvas didn't inline the overrides for some assignment, fall back to fetching those concurrently
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for pa, overs in zip(missing, executor.map(lambda pa : self.get_overrides(pa['canvas_id']), missing)):
+                    pa['overrides'] = overs
+
+        #only the new/updated assignments are written back
+        if self.delta_sync:
+            self.state.save_canvas_delta('assignments', changed)
         return processed_asgns
 
-    def get_submissions(self, assignment_id):
-        subms = self.get('assignments/'+assignment_id+'/submissions')
-        return [ {
+    def get_submissions(self, assignment_id, student_ids = None):
+        subms = self.get_all_submissions([assignment_id], student_ids)
+        return list(subms.values())
+
+    def get_all_submissions(self, assignment_ids, student_ids = None):
+        #get the submissions for several assignments at once from the course-level students/submissions endpoint,
+        #returned as a dict indexed by (assignment_id, student_id)
+        #once every cached submission for an assignment has a posted grade, the only changes we care about
+        #are regrades and resubmissions, so for those assignments only fetch submissions graded/submitted since the last sync
+        #(student_ids, if given, are the students we need submissions for; any not in the cache forces a full fetch)
+        sync_time = plm.now()
+        cached = self.state.load_canvas_submissions(assignment_ids) if self.delta_sync else {}
+        delta_ids = [aid for aid in assignment_ids if aid in cached and
+                                                      all([subm['posted_at'] is not None for subm in cached[aid]['subms'].values()]) and
+                                                      (student_ids is None or all([sid in cached[aid]['subms'] for sid in student_ids]))]
+        full_ids = [aid for aid in assignment_ids if aid not in delta_ids]
+
+        subms = {aid : {} for aid in full_ids}
+        if len(full_ids) > 0:
+            print('Fetching all submissions for ' + str(len(full_ids)) + ' assignments')
+            for subm in self._iter_course_submissions(full_ids, student_ids = student_ids):
+                aid = str(subm['assignment_id'])
+                subms[aid][str(subm['user_id'])] = self._process_submission(subm, aid)
+        changed = {(aid, sid) : subm for aid in full_ids for (sid, subm) in subms[aid].items()}
+
+        if len(delta_ids) > 0:
+            #use the oldest watermark so that no assignment misses a change
+            since = min([cached[aid]['watermark'] for aid in delta_ids], key=plm.parse)
+            print('Fetching submissions graded/submitted since ' + since + ' for ' + str(len(delta_ids)) + ' assignments')
+            for aid in delta_ids:
+                subms[aid] = dict(cached[aid]['subms'])
+            n_changed = 0
+            for key in ['graded_since', 'submitted_since']:
+                for subm in self._iter_course_submissions(delta_ids, {key : since}, student_ids):
+                    aid = str(subm['assignment_id'])
+                    subms[aid][str(subm['user_id'])] = self._process_submission(subm, aid)
+                    changed[(aid, str(subm['user_id']))] = subms[aid][str(subm['user_id'])]
+                    n_changed += 1
+            print(str(n_changed) + ' changed submissions')
+
+        #only the changed submissions are written back (the fully fetched assignments replace what was stored for them)
+        #back the watermark off a bit to allow for clock skew between us and canvas
+        if self.delta_sync:
+            watermark = str(sync_time.subtract(minutes=5))
+            self.state.save_canvas_submissions({aid : watermark for aid in assignment_ids}, changed, full_ids)
+
+        return {(aid, sid) : subm for aid in subms for (sid, subm) in subms[aid].items()}
+
+    def _iter_course_submissions(self, assignment_ids, since = None, student_ids = None):
+        #the raw submission objects for all students for the given assignments, optionally restricted to
+        #those graded/submitted since a time (since = {'graded_since' : time} or {'submitted_since' : time})
+        #(student_ids are the students the caller needs; the REST endpoint just returns everyone's in the same requests)
+        params = {'student_ids[]' : ['all'], 'assignment_ids[]' : assignment_ids, 'exclude_response_fields[]' : ['preview_url']}
+        if since is not None:
+            params.update(since)
+        return self.iter_get('students/submissions', params=params, fields=Canvas.submission_fields)
+
+    def _process_submission(self, subm, assignment_id):
+        return {
                        'student_id' : str(subm['user_id']), 
                        'assignment_id' : assignment_id,
                        'grade' : subm['grade'],
@@ -185,38 +433,26 @@ class Canvas(object):
                        'excused' : subm['excused'],
                        'late_policy_status' : subm['late_policy_status'],
                        'points_deducted' : subm['points_deducted'],
-                       'posted_at' : None if subm['posted_at'] is None else plm.parse(subm['posted_at']),
+                       'posted_at' : parse_date(subm['posted_at']),
                        'late' : subm['late'],
                        'missing' : subm['missing'],
                        'entered_grade' : subm['entered_grade'],
                        'entered_score' : subm['entered_score']
-                } for subm in subms ]
+                }
 
     def get_overrides(self, assignment_id):
         overs = self.get('assignments/'+assignment_id+'/overrides')
-        for over in overs:
-            over['id'] = str(over['id'])
-            over['student_ids'] = list(map(str, over['student_ids']))
-            for key in ['due_at', 'lock_at', 'unlock_at']:
-                if over.get(key) is not None:
-                    over[key] = plm.parse(over[key])
-                else:
-                    over[key] = None
-        return overs
+        return [self._process_override(over) for over in overs]
 
-    def create_override(self, assignment_id, override_dict):
-        #check all required keys
-        required_keys = ['student_ids', 'unlock_at', 'due_at', 'lock_at', 'title']
-        for rk in required_keys:
-            if not override_dict.get(rk):
-                raise InvalidOverrideError(override_dict, missing_key=rk)
-
-        #convert student ids to integers
-        override_dict['student_ids'] = list(map(int, override_dict['student_ids']))
+    def _process_override(self, over):
+        over['id'] = str(over['id'])
+        over['student_ids'] = list(map(str, over['student_ids']))
+        for key in ['due_at', 'lock_at', 'unlock_at']:
+            over[key] = parse_date(over.get(key))
+        return over
 
-        #convert dates to canvas date time strings in the course local timezone
-        for dk in ['unlock_at', 'due_at', 'lock_at']:
-            override_dict[dk] = str(override_dict[dk])
+    def create_override(self, assignment_id, override_dict):
+        self._check_override(override_dict)
 
         #post the override
         post_json = {'assignment_override' : override_dict}
@@ -239,6 +475,57 @@ class Canvas(object):
             if n_match != 0:
                 raise OverrideRemoveError(overs, override_id)    
 
+    def apply_overrides(self, assignment_id, create = [], update = [], remove = []):
+        #apply a set of override changes for one assignment using the batch create/update endpoints
+        #(canvas has no batch delete, so removals are made one at a time), then verify everything with a single fetch
+        #update dicts must include the override 'id', and -- since canvas resets any value omitted from a batch update --
+        #all of the values the override should retain
+        for override_dict in create:
+            self._check_override(override_dict)
+        for override_dict in update:
+            self._format_override(override_dict)
+        #a student can only be in one adhoc override per assignment, so updates/removals (which may take students
+        #out of old overrides) have to happen before any creation
+        self._batch_overrides(assignment_id, update, 'put')
+        for override_id in remove:
+            self.delete('assignments/'+assignment_id+'/overrides/'+override_id)
+        self._batch_overrides(assignment_id, create, 'post')
+
+        #check that everything was applied properly (only if not dry run)
+        if not self.dry_run:
+            overs = self.get_overrides(assignment_id)
+            for override_dict in create + update:
+                n_match = len([over for over in overs if over['title'] == override_dict['title']])
+                if n_match != 1:
+                    raise OverrideUploadError(overs, override_dict)
+            for override_id in remove:
+                n_match = len([over for over in overs if over['id'] == override_id])
+                if n_match != 0:
+                    raise OverrideRemoveError(overs, override_id)
+
+    def _batch_overrides(self, assignment_id, overs, typ):
+        #the batch endpoints are per course, and accept a limited number of overrides per request
+        for i in range(0, len(overs), 50):
+            batch = [dict(over, assignment_id = int(assignment_id)) for over in overs[i:i+50]]
+            self.upload('assignments/overrides', {'assignment_overrides' : batch}, typ)
+
+    def _check_override(self, override_dict):
+        #check all required keys
+        required_keys = ['student_ids', 'unlock_at', 'due_at', 'lock_at', 'title']
+        for rk in required_keys:
+            if not override_dict.get(rk):
+                raise InvalidOverrideError(override_dict, missing_key=rk)
+        self._format_override(override_dict)
+
+    def _format_override(self, override_dict):
+        #convert student ids to integers
+        override_dict['student_ids'] = list(map(int, override_dict['student_ids']))
+
+        #convert dates to canvas date time strings in the course local timezone (leaving unset dates unset)
+        for dk in ['unlock_at', 'due_at', 'lock_at']:
+            if override_dict.get(dk) is not None:
+                override_dict[dk] = str(override_dict[dk])
+
     def put_grade(self, assignment_id, student_id, score):
         self.put('assignments/'+assignment_id+'/submissions/'+student_id, {'submission' : {'posted_grade' : score}})
         #check that it was posted properly
@@ -247,6 +534,45 @@ class Canvas(object):
         if abs(float(score) - float(canvas_grade)) > 0.01:
             raise GradeNotUploadedError(score, canvas_grade)
 
+    def put_grades(self, assignment_id, grades):
+        #upload the grades (dict of student_id : score) for an assignment in one bulk request,
+        #then verify them all with one submissions fetch
+        #returns a dict of student_id : GradeNotUploadedError for any grade that didn't make it onto canvas,
+        #or None in a dry run (nothing was uploaded, so the grades are neither uploaded nor failed)
+        if len(grades) == 0:
+            return {}
+        #setting the same grades twice is harmless, so this post is safe to retry
+        progress = self.post('assignments/'+assignment_id+'/submissions/update_grades', {'grade_data' : {sid : {'posted_grade' : score} for (sid, score) in grades.items()}}, safe = True)
+        if self.dry_run:
+            return None
+
+        #bulk grading runs asynchronously on canvas; wait for the job to finish before verifying
+        self.wait_for_progress(progress)
+
+        canvas_grades = {str(subm['user_id']) : subm['score'] for subm in self.iter_get('students/submissions', params={'student_ids[]' : ['all'], 'assignment_ids[]' : [assignment_id], 'exclude_response_fields[]' : ['preview_url']}, fields=['user_id', 'score'])}
+        errors = {}
+        for sid in grades:
+            canvas_grade = canvas_grades.get(sid)
+            if canvas_grade is None or abs(float(grades[sid]) - float(canvas_grade)) > 0.01:
+                errors[sid] = GradeNotUploadedError(grades[sid], canvas_grade)
+        return errors
+
+    def wait_for_progress(self, progress, timeout = 600):
+        #poll a canvas Progress object until its job completes or fails (or we give up waiting)
+        poll_interval = 1.
+        start = time.time()
+        while progress['workflow_state'] not in ['completed', 'failed']:
+            if time.time() - start > timeout:
+                print('Canvas job ' + str(progress['id']) + ' did not finish within ' + str(timeout) + 's (state: ' + progress['workflow_state'] + ')')
+                break
+            time.sleep(poll_interval)
+            poll_interval = min(2*poll_interval, 10.)
+            #progress['url'] is absolute, so urljoin leaves it alone
+            progress = self.get(progress['url'])[0]
+        if progress['workflow_state'] == 'failed':
+            print('Canvas job ' + str(progress['id']) + ' failed: ' + str(progress.get('message')))
+        return progress
+
 # TODO add these in???
 #def get_grades(course, assignment): #???
 #    '''Takes a course object, an assignment name, and get the grades for that assignment from Canvas.
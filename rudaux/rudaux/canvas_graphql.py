@@ -0,0 +1,174 @@
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from .canvas import Canvas, CanvasGetError
+
+class GraphQLError(Exception):
+    def __init__(self, query, errors):
+        self.query = query
+        self.errors = errors
+        self.message = 'Canvas GraphQL query failed: ' + str(errors)
+
+ENROLLMENTS_QUERY = """
+query Enrollments($courseId: ID!, $cursor: String, $filter: EnrollmentFilterInput) {
+  course(id: $courseId) {
+    enrollmentsConnection(first: 100, after: $cursor, filter: $filter) {
+      nodes {
+        _id
+        type
+        state
+        createdAt
+        updatedAt
+        user { _id name sortableName shortName sisId }
+      }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+SUBMISSIONS_QUERY = """
+query Submissions($courseId: ID!, $studentIds: [ID!], $cursor: String, $filter: SubmissionFilterInput) {
+  course(id: $courseId) {
+    submissionsConnection(first: 100, after: $cursor, studentIds: $studentIds, filter: $filter) {
+      nodes {
+        assignment { _id }
+        userId
+        grade
+        score
+        state
+        excused
+        latePolicyStatus
+        deductedPoints
+        postedAt
+        late
+        missing
+        enteredGrade
+        enteredScore
+      }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+GROUPS_QUERY = """
+query Groups($courseId: ID!, $cursor: String) {
+  course(id: $courseId) {
+    groupsConnection(first: 100, after: $cursor) {
+      nodes {
+        _id
+        name
+        membersConnection(first: 100) {
+          nodes { user { _id } }
+          pageInfo { hasNextPage }
+        }
+      }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+class GraphQLCanvas(Canvas):
+    """
+    Interface to Canvas that obtains enrollments, submissions and groups through batched GraphQL queries
+    (everything else goes through the REST API)
+    """
+
+    def __init__(self, config, dry_run, course_dir, state):
+        super().__init__(config, dry_run, course_dir, state)
+        self.graphql_url = urllib.parse.urljoin(config.canvas_domain, 'api/graphql')
+        self.course_id = config.canvas_id
+        #full submission fetches for more students than this are split into chunks of students fetched concurrently
+        self.submission_chunk_students = config.get('canvas_graphql_chunk_students', 100)
+
+    def query(self, query, variables):
+        resp = self.throttle.request(self.session.post, url = self.graphql_url, json = {'query' : query, 'variables' : variables})
+        if resp.status_code < 200 or resp.status_code > 299:
+            raise CanvasGetError(self.graphql_url, resp)
+        data = resp.json()
+        if data.get('errors'):
+            raise GraphQLError(query, data['errors'])
+        return data['data']
+
+    def iter_connection(self, query, variables, path):
+        #yield the nodes of a paginated connection; path is the list of keys leading to the connection in the result
+        cursor = None
+        while True:
+            conn = self.query(query, dict(variables, cursor = cursor))
+            for key in path:
+                conn = conn[key]
+            yield from conn['nodes']
+            if not conn['pageInfo']['hasNextPage']:
+                break
+            cursor = conn['pageInfo']['endCursor']
+
+    def _iter_enrollments(self, types):
+        #translate the graphql enrollments into the REST enrollment shape that get_people processes
+        variables = {'courseId' : self.course_id, 'filter' : None if types is None else {'types' : types}}
+        for e in self.iter_connection(ENROLLMENTS_QUERY, variables, ['course', 'enrollmentsConnection']):
+            yield {'id' : e['_id'],
+                   'type' : e['type'],
+                   'enrollment_state' : e['state'],
+                   'created_at' : e['createdAt'],
+                   'updated_at' : e['updatedAt'],
+                   'user' : {'id' : e['user']['_id'],
+                             'name' : e['user']['name'],
+                             'sortable_name' : e['user']['sortableName'],
+                             'short_name' : e['user']['shortName'],
+                             'sis_user_id' : e['user']['sisId']}}
+
+    def _iter_course_submissions(self, assignment_ids, since = None, student_ids = None):
+        #the course-level submissions connection covers every assignment at once (and, unlike the per-assignment one,
+        #takes the graded/submitted since filters); it can't be filtered by assignment, so other assignments' submissions
+        #are dropped here. For a full fetch of many students, the students are split into chunks whose connections are fetched
+        #concurrently; delta (since) fetches return few submissions, so they're a single connection to keep the request count down
+        filt = {'states' : ['unsubmitted', 'submitted', 'pending_review', 'graded']}
+        if since is not None:
+            keys = {'graded_since' : 'gradedSince', 'submitted_since' : 'submittedSince'}
+            filt.update({keys[k] : v for (k, v) in since.items()})
+        assignment_ids = set([str(aid) for aid in assignment_ids])
+        if student_ids is None:
+            chunks = [None]
+        elif since is not None or len(student_ids) <= self.submission_chunk_students:
+            chunks = [list(student_ids)]
+        else:
+            student_ids = list(student_ids)
+            chunk_size = max(self.submission_chunk_students, -(-len(student_ids)//self.max_workers))
+            chunks = [student_ids[k:k+chunk_size] for k in range(0, len(student_ids), chunk_size)]
+
+        def fetch(chunk):
+            return [{'assignment_id' : s['assignment']['_id'],
+                     'user_id' : s['userId'],
+                     'grade' : s['grade'],
+                     'score' : s['score'],
+                     'workflow_state' : s['state'],
+                     'excused' : s['excused'],
+                     'late_policy_status' : s['latePolicyStatus'],
+                     'points_deducted' : s['deductedPoints'],
+                     'posted_at' : s['postedAt'],
+                     'late' : s['late'],
+                     'missing' : s['missing'],
+                     'entered_grade' : s['enteredGrade'],
+                     'entered_score' : s['enteredScore']}
+                    for s in self.iter_connection(SUBMISSIONS_QUERY, {'courseId' : self.course_id, 'studentIds' : chunk, 'filter' : filt},
+                                                  ['course', 'submissionsConnection'])
+                    if str(s['assignment']['_id']) in assignment_ids]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for subms in executor.map(fetch, chunks):
+                yield from subms
+
+    def get_groups(self):
+        #groups and their members come back together, so there's no per-group membership request
+        #(except for groups with more than 100 members, whose members are fetched through REST)
+        groups = []
+        for g in self.iter_connection(GROUPS_QUERY, {'courseId' : self.course_id}, ['course', 'groupsConnection']):
+            if g['membersConnection']['pageInfo']['hasNextPage']:
+                members = [str(m['user_id']) for m in self.get(str(g['_id'])+'/memberships', use_group_base=True)]
+            else:
+                members = [str(m['user']['_id']) for m in g['membersConnection']['nodes']]
+            groups.append({'name' : g['name'],
+                           'canvas_id' : str(g['_id']),
+                           'members' : members})
+        return groups
@@ -37,14 +37,19 @@ def print_list(args):
     for po in printouts:
         if vars(args)[po] or none_selected:
             title = printouts[po]
-            if len(course.__dict__[po]) > 0:
-                tbl = [type(course.__dict__[po][0]).table_headings()]
-                for obj in course.__dict__[po]:
+            objs = getattr(course, po)
+            if len(objs) > 0:
+                tbl = [type(objs[0]).table_headings()]
+                for obj in objs:
                     tbl.append(obj.table_items())
             else:
                 tbl = []
             print(ttbl.AsciiTable(tbl, title).table)
 
+def prune(args):
+    course = rudaux.Course(args.directory, dry_run = args.dry_run)
+    course.prune_snapshots()
+
 def apply_latereg_extensions(args):
     course = rudaux.Course(args.directory, dry_run = args.dry_run)
     course.apply_latereg_extensions()
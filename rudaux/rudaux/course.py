@@ -1,5 +1,4 @@
 import os, sys, pwd
-import pickle as pk
 import tqdm
 import pendulum as plm
 import terminaltables as ttbl
@@ -8,11 +7,14 @@ from traitlets.config.loader import PyFileConfigLoader
 import editdistance
 from subprocess import CalledProcessError
 from .canvas import Canvas, GradeNotUploadedError
+from .canvas_graphql import GraphQLCanvas
 from .jupyterhub import JupyterHub
-from .zfs import ZFS
+from .zfs import ZFS, FakeZFS
 from .person import Person
 from .group import Group
 from .assignment import Assignment
+from .duedates import DueDateIndex
+from .state import StateStore
 from .docker import Docker, DockerError
 from .submission import Submission, SubmissionStatus, MultipleGraderError
 from .notification import SMTP
@@ -20,12 +22,38 @@ import git
 import shutil
 import random
 import traceback
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def canvas_entity(name):
+    #a Course attribute that is obtained from canvas the first time it is read
+    def getter(self):
+        if name not in self._canvas_state:
+            self.load_canvas_entity(name)
+        return self._canvas_state[name]
+    def setter(self, value):
+        self._set_canvas_state({name : value})
+    return property(getter, setter)
 
 class Course(object):
     """
     Course object for managing a Canvas/JupyterHub/nbgrader course.
     """
 
+    canvas_entities = ['course_info', 'students', 'tas', 'instructors', 'fake_students', 'assignments', 'groups']
+    enrollment_types = {'students' : 'StudentEnrollment',
+                        'tas' : 'TaEnrollment',
+                        'instructors' : 'TeacherEnrollment',
+                        'fake_students' : 'StudentViewEnrollment'}
+
+    course_info = canvas_entity('course_info')
+    students = canvas_entity('students')
+    tas = canvas_entity('tas')
+    instructors = canvas_entity('instructors')
+    fake_students = canvas_entity('fake_students')
+    assignments = canvas_entity('assignments')
+    groups = canvas_entity('groups')
+
     def __init__(self, course_dir, dry_run = False, allow_canvas_cache = False):
         """
         Initialize a course from a config file. 
@@ -38,6 +66,7 @@ class Course(object):
 
         self.course_dir = course_dir
         self.dry_run = dry_run
+        self.allow_canvas_cache = allow_canvas_cache
 
         #=======================================#
         #              Load Config              #
@@ -69,10 +98,23 @@ class Course(object):
         #      Create Canvas object and try to load state (if failure, load cached if we're allowed to)     #
         #===================================================================================================#
 
+        #all persistent course state lives in one sqlite database (see state.py); old pickle files are migrated into it
+        self.state_filename = os.path.join(self.course_dir, self.config.name + '_state.db')
+        self.state = StateStore(self.state_filename)
+        if not self.dry_run:
+            self.state.migrate_pickles(os.path.join(self.course_dir, self.config.name + '_canvas_cache.pk'),
+                                       os.path.join(self.course_dir, self.config.name + '_snapshots.pk'),
+                                       os.path.join(self.course_dir, self.config.name + '_submissions.pk'))
+        else:
+            print('[Dry Run: old pickle files (if any) not migrated into the state database]')
+
         print('Creating Canvas interface...')
-        self.canvas = Canvas(self.config, self.dry_run)
-        self.canvas_cache_filename = os.path.join(self.course_dir, self.config.name + '_canvas_cache.pk')
-        self.synchronize_canvas(allow_canvas_cache)
+        canvas_backends = {'rest' : Canvas, 'graphql' : GraphQLCanvas}
+        self.canvas = canvas_backends[self.config.get('canvas_backend', 'rest')](self.config, self.dry_run, self.course_dir, self.state)
+        #canvas entities (course_info, students, assignments, etc) are obtained on first access,
+        #so each command only pays for the data it uses (see canvas_entity below)
+        self._canvas_state = {}
+        self._due_dates = None
         
         #=======================================================#
         #      Create the JupyterHub Interface                  #
@@ -86,7 +128,8 @@ class Course(object):
         #=======================================================#
 
         print('Creating ZFS interface...')
-        self.zfs = ZFS(self.config, self.dry_run)
+        storage_backends = {'zfs' : ZFS, 'fake' : FakeZFS}
+        self.zfs = storage_backends[self.config.get('storage_backend', 'zfs')](self.config, self.dry_run)
 
         #=======================================================#
         #      Create the interface to Docker                   #
@@ -106,206 +149,335 @@ class Course(object):
         #      Load the saved state                             #
         #=======================================================#
         print('Loading snapshots...')
-        self.snapshots_filename = os.path.join(self.course_dir, self.config.name +'_snapshots.pk')
         self.load_snapshots()
-        print('Loading submissions...')
-        self.submissions_filename = os.path.join(self.course_dir, self.config.name +'_submissions.pk')
-        self.load_submissions()
         
         print('Done.')
        
-    def synchronize_canvas(self, allow_cache = False):
+    def synchronize_canvas(self, allow_cache = False, entities = None):
+        #eagerly (re)load canvas entities (by default everything except groups) rather than waiting for first access
+        #if anything fails, fall back to the cache for all of them (if allowed)
+        if entities is None:
+            entities = [name for name in Course.canvas_entities if name != 'groups']
         try:
             print('Synchronizing with Canvas...')
-
-            print('Obtaining course information...')
-            self.course_info = self.canvas.get_course_info()
-            print('Done.')
-            
-            print('Obtaining/processing student enrollment information from Canvas...')
-            student_dicts = self.canvas.get_students()
-            self.students = [Person(sd) for sd in student_dicts]
-            print('Done.')
-
-            print('Obtaining/processing TA enrollment information from Canvas...')
-            ta_dicts = self.canvas.get_tas()
-            self.tas = [Person(ta) for ta in ta_dicts]
-            print('Done.')
-
-            print('Obtaining/processing instructor enrollment information from Canvas...')
-            instructor_dicts = self.canvas.get_instructors()
-            self.instructors = [Person(inst) for inst in instructor_dicts]
-            print('Done.')
-
-            print('Obtaining/processing student view / fake student enrollment information from Canvas...')
-            fake_student_dicts = self.canvas.get_fake_students()
-            self.fake_students = [Person(fsd) for fsd in fake_student_dicts]
-            print('Done.')
-
-            print('Obtaining/processing assignment information from Canvas...')
-            assignment_dicts = self.canvas.get_assignments()
-            self.assignments = [Assignment(ad) for ad in assignment_dicts]
-            print('Done.')
-
-            print('Obtaining/processing group information from Canvas...')
-            group_dicts = self.canvas.get_groups()
-            self.groups = [Group(gr) for gr in group_dicts]
-            print('Done.')
+            loaded = self._fetch_canvas_entities(entities)
         except Exception as e:
             print('Exception encountered during synchronization')
             print(e)
             print(traceback.format_exc())
-            if allow_canvas_cache:
+            if allow_cache:
                 print('Attempting to fall back to cache...')
-                if os.path.exists(self.canvas_cache_filename):
-                    print('Loading cached canvas state from ' + self.canvas_cache_filename)
-                    canvas_cache = None
-                    with open(self.canvas_cache_filename, 'rb') as f:
-                        canvas_cache = pk.load(f)
-                    self.course_info = canvas_cache['course_info']
-                    self.students = canvas_cache['students']
-                    self.fake_students = canvas_cache['fake_students']
-                    self.instructors = canvas_cache['instructors']
-                    self.tas = canvas_cache['tas']
-                    self.assignments = canvas_cache['assignments']
-                    self.groups = canvas_cache['groups']
+                canvas_cache = self.load_canvas_cache(entities)
+                if all([name in canvas_cache for name in entities]):
+                    print('Loading cached canvas state from ' + self.state_filename)
+                    self._set_canvas_state({name : canvas_cache[name] for name in entities})
         else:
+            self._set_canvas_state(loaded)
+            self.canvas.throttle.report()
             print('Saving canvas cache file...')
-            with open(self.canvas_cache_filename, 'wb') as f:
-                pk.dump({'course_info' : self.course_info,
-                         'students' : self.students,
-                         'fake_students' : self.fake_students,
-                         'instructors' : self.instructors,
-                         'tas' : self.tas,
-                         'assignments' : self.assignments,
-                         'groups' : self.groups,
-                         }, f)
+            self.save_canvas_cache(loaded)
         return
-    
-    def load_snapshots(self):
-        print('Loading the list of taken snapshots...')
-        if os.path.exists(self.snapshots_filename):
-            with open(self.snapshots_filename, 'rb') as f:
-                self.snapshots = pk.load(f)
-        else: 
-            print('No snapshots file found. Initializing empty list.')
-            self.snapshots = []
-        return
-
 
-    #TODO remove load/save submissions? unused I think
-    def load_submissions(self):
-        print('Loading the list of submissions...')
-        if os.path.exists(self.submissions_filename):
-            with open(self.submissions_filename, 'rb') as f:
-                self.submissions = pk.load(f)
-        else: 
-            print('No submissions file found. Initializing empty dict.')
-            self.submissions = {}
-        return
+    def prefetch_canvas(self, entities):
+        #commands that are about to read several canvas entities fetch the ones not loaded yet together,
+        #so they're obtained concurrently rather than one after another on first access
+        missing = [name for name in entities if name not in self._canvas_state]
+        if len(missing) > 1:
+            self.synchronize_canvas(allow_cache = self.allow_canvas_cache, entities = missing)
 
-    def save_snapshots(self):
-        print('Saving the taken snapshots list...')
-        if not self.dry_run:
-            with open(self.snapshots_filename, 'wb') as f:
-                pk.dump(self.snapshots, f)
-            print('Done.')
+    def load_canvas_entity(self, name):
+        #load a single canvas entity on first access, falling back to the cache for that entity alone (if allowed)
+        try:
+            loaded = self._fetch_canvas_entities([name])
+        except Exception as e:
+            print('Exception encountered while obtaining ' + name + ' from Canvas')
+            print(e)
+            print(traceback.format_exc())
+            canvas_cache = self.load_canvas_cache([name])
+            if not (self.allow_canvas_cache and name in canvas_cache):
+                raise
+            print('Loading cached ' + name + ' from ' + self.state_filename)
+            self._set_canvas_state({name : canvas_cache[name]})
         else:
-            print('[Dry Run: snapshot list not saved]')
+            self._set_canvas_state(loaded)
+            self.save_canvas_cache(loaded)
+
+    def _set_canvas_state(self, entries):
+        self._canvas_state.update(entries)
+        #the due date index depends on the students and assignments, so rebuild it on next use if they change
+        if 'students' in entries or 'assignments' in entries:
+            self._due_dates = None
+
+    @property
+    def due_dates(self):
+        #effective due dates for every student x assignment, built once per sync and shared by everything that needs them
+        if self._due_dates is None:
+            print('Building due date index...')
+            self._due_dates = DueDateIndex(self.assignments, self.students)
+        return self._due_dates
+
+    def _fetch_canvas_entities(self, entities):
+        #the entity types don't depend on each other, so fetch them concurrently (over the canvas session's shared
+        #connection pool); any failure propagates so that the callers' cache fallback stays all-or-nothing
+        fetches = {}
+        if 'course_info' in entities:
+            fetches['course information'] = self._fetch_course_info
+
+        #all requested enrollment types come from a single enrollments request
+        people_entities = [name for name in entities if name in Course.enrollment_types]
+        if len(people_entities) > 0:
+            fetches['enrollments (' + ', '.join(people_entities) + ')'] = lambda : self._fetch_people(people_entities)
+
+        if 'assignments' in entities:
+            fetches['assignments'] = self._fetch_assignments
+
+        if 'groups' in entities:
+            fetches['groups'] = self._fetch_groups
+
+        def timed(item):
+            desc, fetch = item
+            print('Obtaining/processing ' + desc + ' from Canvas...')
+            start = time.time()
+            result = fetch()
+            print('Done obtaining/processing ' + desc + ' (' + '{:.2f}'.format(time.time() - start) + 's)')
+            return result
+
+        loaded = {}
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, len(fetches))) as executor:
+            for result in executor.map(timed, fetches.items()):
+                loaded.update(result)
+        print('Canvas synchronization took ' + '{:.2f}'.format(time.time() - start) + 's')
+        return loaded
+
+    def _fetch_course_info(self):
+        return {'course_info' : self.canvas.get_course_info()}
+
+    def _fetch_people(self, people_entities):
+        people = self.canvas.get_people([Course.enrollment_types[name] for name in people_entities])
+        return {name : [Person(pd) for pd in people[Course.enrollment_types[name]]] for name in people_entities}
+
+    def _fetch_assignments(self):
+        return {'assignments' : [Assignment(ad) for ad in self.canvas.get_assignments()]}
+
+    def _fetch_groups(self):
+        return {'groups' : [Group(gr) for gr in self.canvas.get_groups()]}
+
+    def load_canvas_cache(self, names = None):
+        return self.state.load_canvas_entities(names)
+
+    def save_canvas_cache(self, entries):
+        #only the given entities are rewritten; others (e.g. groups loaded separately) are kept
+        self.state.save_canvas_entities(entries)
+    
+    def load_snapshots(self):
+        print('Loading the list of taken snapshots...')
+        self.snapshots = self.state.load_snapshots()
         return
 
-    def save_submissions(self):
-        print('Saving the submissions list...')
-        if not self.dry_run:
-            with open(self.submissions_filename, 'wb') as f:
-                pk.dump(self.submissions, f)
-            print('Done.')
-        else:
-            print('[Dry Run: submissions not saved]')
-        return
+    def record_snapshots(self, names):
+        #add taken snapshots to the list and save them right away, so a crash later in the run can't lose them
+        names = [name for name in dict.fromkeys(names) if name not in self.snapshots]
+        self.snapshots.extend(names)
+        self.state.add_snapshots(names)
 
     #TODO throughout: there is a lot of checking for a.due_at and a.unlock_at -- make sure to have an "else" and print some msg if check fails
     #TODO alternatively, when we synch canvas, only keep assignments with a due&unlock date, and report others as invalid and remove
 
-    #TODO rather than save a list of taken snapshots and update it, detect which snapshots were already taken from zfs list
+    def load_snapshot_inventory(self):
+        #get every dataset/snapshot under the user folder root from zfs with one call; returns whether that worked
+        print('Listing zfs snapshots...')
+        try:
+            self.zfs.load_inventory()
+        except (CalledProcessError, OSError) as e:
+            print('Error listing zfs snapshots; falling back to the saved list of taken snapshots')
+            print(e)
+            self.zfs.inventory = None
+        return self.zfs.inventory is not None
+
+    def snapshot_taken(self, snap_name, user = None):
+        #a snapshot counts as taken if zfs has it, or if it's in the saved list: that covers snapshots that were
+        #skipped because the student had no dataset at the due date, and ones that have since been pruned
+        #(which must never be taken again after the due date)
+        #(per-student snapshots are saved as <student>@<snapshot>; bare names cover everyone)
+        if snap_name in self.snapshots or (user is not None and user + '@' + snap_name in self.snapshots):
+            return True
+        return self.zfs.inventory is not None and self.zfs.has_snapshot(snap_name, user)
+
     def take_snapshots(self):
         print('Taking snapshots')
+        self.load_snapshot_inventory()
+
+        #gather every snapshot that is due but not taken yet
+        asgn_snaps = []
+        override_snaps = []
+        missing_snaps = []
         for a in self.assignments:
-            if (a.due_at is not None) and a.due_at < plm.now() and a.name not in self.snapshots:
-                print('Assignment ' + a.name + ' is past due and no snapshot exists yet. Taking a snapshot [' + a.name + ']')
-                try:
-                    self.zfs.snapshot_all(a.name)
-                except CalledProcessError as e:
-                    print('Error creating snapshot ' + a.name)
-                    print('Return code ' + str(e.returncode))
-                    print(e.output.decode('utf-8'))
-                    print('Not updating the taken snapshots list')
-                else:
-                    if not self.dry_run:
-                        self.snapshots.append(a.name)
-                    else:
-                        print('[Dry Run: snapshot name not added to taken list; would have added ' + a.name + ']')
+            if (a.due_at is not None) and a.due_at < plm.now() and not self.snapshot_taken(a.name):
+                print('Assignment ' + a.name + ' is past due and no snapshot exists yet. Snapshot [' + a.name + '] needed')
+                asgn_snaps.append((None, a.name))
+            #a snapshot at release time lets us tell which students changed nothing before the due date (see Submission.prepare)
+            #it's only useful if taken before any student could start working, so take it on a snapshot pass in the hour
+            #before the assignment unlocks, and never after
+            release_snapname = a.name + '-release'
+            if (a.unlock_at is not None) and a.unlock_at.subtract(hours=1) < plm.now() <= a.unlock_at and not self.snapshot_taken(release_snapname):
+                print('Assignment ' + a.name + ' unlocks within the hour. Snapshot [' + release_snapname + '] needed')
+                asgn_snaps.append((None, release_snapname))
             for over in a.overrides:
                 snapname = a.name + '-override-' + over['id'] #TODO don't hard code this pattern here since we need it in submission too
-                if (over['due_at'] is not None) and over['due_at'] < plm.now() and not (snapname in self.snapshots):
-                    print('Assignment ' + a.name + ' has override ' + over['id'] + ' for student ' + over['student_ids'][0] + ' and no snapshot exists yet. Taking a snapshot [' + snapname + ']')
-                    add_to_taken_list = True
-                    try:
-                        self.zfs.snapshot_user(over['student_ids'][0], snapname)
-                    except CalledProcessError as e:
-                        print('Error creating snapshot ' + snapname)
-                        print('Return code ' + str(e.returncode))
-                        print(e.output.decode('utf-8'))
-                        if 'dataset does not exist' not in e.output.decode('utf-8'):
-                            print('Unknown error; not updating the taken snapshots list')
-                            add_to_taken_list = False
+                if (over['due_at'] is None) or over['due_at'] >= plm.now():
+                    continue
+                for sid in over['student_ids']:
+                    if not self.snapshot_taken(snapname, sid):
+                        if self.zfs.inventory is not None and not self.zfs.dataset_exists(sid):
+                            print('Assignment ' + a.name + ' has override ' + over['id'] + ' for student ' + sid + ', but the student hasnt created their folder; this counts as a missing submission.')
+                            missing_snaps.append(sid + '@' + snapname)
                         else:
-                            print('Student hasnt created their folder; this counts as a missing submission. Updating taken snapshots list.')
+                            print('Assignment ' + a.name + ' has override ' + over['id'] + ' for student ' + sid + ' and no snapshot exists yet. Snapshot [' + snapname + '] needed')
+                            override_snaps.append((sid, snapname))
+
+        #take them in as few zfs calls as possible: one recursive call per assignment snapshot name, and for the overrides,
+        #one call per round of students (zfs takes at most one snapshot of a dataset per call; see ZFS.snapshot_rounds)
+        print('Taking ' + str(len(asgn_snaps)) + ' assignment snapshots and ' + str(len(override_snaps)) + ' override snapshots')
+        failed = {}
+        if len(asgn_snaps) > 0:
+            failed.update(self.zfs.snapshot_batch(asgn_snaps, recursive = True))
+        if len(override_snaps) > 0:
+            failed.update(self.zfs.snapshot_batch(override_snaps))
+
+        taken = missing_snaps
+        for (user, snapname) in asgn_snaps + override_snaps:
+            if (user, snapname) not in failed:
+                taken.append(snapname if user is None else user + '@' + snapname)
+                continue
+            print('Error creating snapshot ' + snapname + ('' if user is None else ' for student ' + user))
+            print(failed[(user, snapname)])
+            if user is not None and self.zfs.missing_dataset_error(failed[(user, snapname)], user):
+                print('Student hasnt created their folder; this counts as a missing submission. Updating taken snapshots list.')
+                taken.append(user + '@' + snapname)
+            else:
+                print('Not updating the taken snapshots list')
+
+        if not self.dry_run:
+            self.record_snapshots(taken)
+        else:
+            print('[Dry Run: snapshot names not added to taken list; would have added ' + str(taken) + ']')
+        print('Done.')
 
-                    if not self.dry_run and add_to_taken_list:
-                        self.snapshots.append(snapname)
-                    elif self.dry_run:
-                        print('[Dry Run: snapshot name not added to taken list; would have added ' + snapname + ']')
+    def prune_snapshots(self):
+        #destroy rudaux's snapshots that no longer back an unfinalized submission (and are older than the retention period)
+        print('Pruning snapshots')
+        if not self.load_snapshot_inventory():
+            print('Could not list zfs snapshots; not pruning anything')
+            return
+        self.prefetch_canvas(['students', 'assignments'])
+        retention_days = self.config.get('snapshot_retention_days', 14)
+        require_posted = self.config.get('snapshot_retention_require_posted', False)
+        cutoff = plm.now().subtract(days=retention_days).timestamp()
+
+        #the assignment each snapshot name belongs to
+        snap_assignments = {}
+        for a in self.assignments:
+            snap_assignments[a.name] = a
+            snap_assignments[a.name + '-release'] = a
+            for over in a.overrides:
+                snap_assignments[a.name + '-override-' + over['id']] = a
+
+        #a student's submission is finalized once its grade is on canvas (and posted, if required by the policy)
+        student_ids = [stu.canvas_id for stu in self.students]
+        canvas_subms = self.canvas.get_all_submissions([a.canvas_id for a in self.assignments], student_ids)
+        student_ids = set(student_ids)
+        def finalized(aid, sid):
+            subm = canvas_subms.get((aid, sid))
+            return subm is not None and subm['score'] is not None and (subm['posted_at'] is not None or not require_posted)
+
+        prunable = {}
+        n_kept = 0
+        for ds, snaps in self.zfs.inventory.items():
+            user = None if ds == self.zfs.root_dataset else ds[len(self.zfs.root_dataset)+1:].split('/')[0]
+            for snap_name, info in snaps.items():
+                #only touch this course's own snapshots, never the grader templates' (grader folders are clones of them)
+                if info['owner'] != self.config.name or (user is not None and user.startswith('rudaux-template-')):
+                    continue
+                a = snap_assignments.get(snap_name)
+                if info['creation'] > cutoff or (a is not None and user in student_ids and not finalized(a.canvas_id, user)):
+                    n_kept += 1
+                    continue
+                prunable.setdefault(ds, []).append(snap_name)
+
+        print('Keeping ' + str(n_kept) + ' snapshots; pruning ' + str(sum([len(v) for v in prunable.values()])) + ' snapshots on ' + str(len(prunable)) + ' datasets')
+        failed = self.zfs.destroy_snapshots(prunable)
+        for arg in failed:
+            print('Error destroying snapshots ' + arg)
+            print(failed[arg])
         print('Done.')
-        self.save_snapshots() 
 
     def apply_latereg_extensions(self): 
+        self.prefetch_canvas(['course_info', 'students', 'assignments'])
         need_synchronize = False
         tz = self.course_info['time_zone']
         fmt = 'ddd YYYY-MM-DD HH:mm:ss'
         print('Applying late registration extensions')
+        #work out all the override changes first, then apply them per assignment
+        changes = {}
         for a in self.assignments:
             print('Checking ' + str(a.name))
             print('Due: ' + str(a.due_at.in_timezone(tz).format(fmt) if a.due_at is not None else a.due_at) + ' Unlock: ' + str(a.unlock_at.in_timezone(tz).format(fmt) if a.unlock_at is not None else a.unlock_at))
             if (a.due_at is not None) and (a.unlock_at is not None): #if the assignment has both a due date and unlock date set
+                create, update, shrink = [], [], {}
                 for s in self.students:
                     regdate = s.reg_updated if (s.reg_updated is not None) else s.reg_created
                     if s.status == 'active' and regdate > a.unlock_at:
                         #if student s active and registered after assignment a was unlocked
                         print('Student ' + s.name + ' registration date (' + regdate.in_timezone(tz).format(fmt)+') after unlock date of assignment ' + a.name + ' (' + a.unlock_at.in_timezone(tz).format(fmt) + ')')
                         #get their due date w/ no late registration
-                        due_date, override = a.get_due_date(s)
+                        due_date, override = self.due_dates.get_due_date(a, s)
                         print('Current due date: ' + due_date.in_timezone(tz).format(fmt) + ' from override: ' + str(True if (override is not None) else False))
                         #the late registration due date
                         latereg_date = regdate.add(days=self.config.latereg_extension_days)
                         print('Late registration extension date: ' + latereg_date.in_timezone(tz).format(fmt))
                         if latereg_date > due_date:
-                            print('Creating automatic late registration extension to ' + latereg_date.in_timezone(tz).format(fmt)) 
-                            if override is not None:
-                                print('Removing old override')
-                                self.canvas.remove_override(a.canvas_id, override['id'])
-                            need_synchronize = True
-                            self.canvas.create_override(a.canvas_id, {'student_ids' : [s.canvas_id],
-                                                                  'due_at' : latereg_date,
-                                                                  'lock_at' : a.lock_at,
-                                                                  'unlock_at' : a.unlock_at,
-                                                                  'title' : s.name+'-'+a.name+'-latereg'}
-                                                   )
+                            print('Planning automatic late registration extension to ' + latereg_date.in_timezone(tz).format(fmt))
+                            new_override = {'student_ids' : [s.canvas_id],
+                                            'due_at' : latereg_date,
+                                            'lock_at' : a.lock_at,
+                                            'unlock_at' : a.unlock_at,
+                                            'title' : s.name+'-'+a.name+'-latereg'}
+                            if override is not None and override['student_ids'] == [s.canvas_id]:
+                                #the old override is just for this student, so it can be updated in place
+                                print('Updating old override')
+                                update.append(dict(new_override, id = override['id']))
+                            else:
+                                if override is not None:
+                                    #the old override covers other students too; take this student out of it
+                                    print('Removing student from old override')
+                                    shrink.setdefault(override['id'], (override, set()))[1].add(s.canvas_id)
+                                create.append(new_override)
                         else:
                             print('Current due date after registration extension date. No extension required. Skipping.')
+                if len(create) + len(update) + len(shrink) > 0:
+                    changes[a.canvas_id] = (a, create, update, shrink)
             else:
                 print('Assignment missing either a due date (' + str(a.due_at) + ') or unlock date (' + str(a.unlock_at) + '). Not checking.')
 
+        #apply all the changes for each assignment at once (this also verifies them with a single fetch per assignment)
+        for aid, (a, create, update, shrink) in changes.items():
+            remove = []
+            for oid, (override, removed) in shrink.items():
+                remaining = [sid for sid in override['student_ids'] if sid not in removed]
+                if len(remaining) == 0:
+                    remove.append(oid)
+                else:
+                    update.append({'id' : oid,
+                                   'student_ids' : remaining,
+                                   'due_at' : override['due_at'],
+                                   'lock_at' : override['lock_at'],
+                                   'unlock_at' : override['unlock_at'],
+                                   'title' : override['title']})
+            print('Applying ' + str(len(create)) + ' new, ' + str(len(update)) + ' updated, and ' + str(len(remove)) + ' removed overrides for ' + a.name)
+            self.canvas.apply_overrides(aid, create, update, remove)
+            need_synchronize = True
+
         #TODO create a "needs_synch" flag instead of doing it now; lazy synch
         #if need_synchronize:
         #    print('Overrides changed. Deleting out-of-date cache and forcing canvas synchronize...')
@@ -320,8 +492,8 @@ class Course(object):
     #TODO what happens if rudaux config doesn't have this one's name?
     def create_grader_folders(self, a):
         print('Creating grader folders/accounts for assignments')
-        #TODO don't hardcode 'jupyter' here
-        jupyter_uid = pwd.getpwnam('jupyter').pw_uid
+        #if enabled, build one template grader folder for the assignment and create grader folders as zfs clones of it
+        template_name = self.create_grader_template(a) if self.config.get('clone_grader_folders', False) else None
         # create a user folder and jupyterhub account for each grader if needed
         print('Checking assignment ' + a.name + ' with grader list ' + str(self.config.graders[a.name]))
         for i in range(len(self.config.graders[a.name])):
@@ -330,9 +502,14 @@ class Course(object):
 
             # create the zfs volume and clone the instructor repo
             print('Checking if grader folder exists..')
+            cloned = False
             if not self.zfs.user_folder_exists(grader_name):
                 print('Assignment ' + a.name + ' past due, no ' + grader_name + ' folder created yet. Creating')
-                self.zfs.create_user_folder(grader_name)
+                if template_name is not None:
+                    self.zfs.clone_user_folder(template_name, 'ready', grader_name)
+                    cloned = True
+                else:
+                    self.zfs.create_user_folder(grader_name)
             print('Grading folder exists')
 
             # create the jupyterhub user
@@ -343,59 +520,86 @@ class Course(object):
             else:
                 print('User exists!')
 
-            # if not a valid repo with an nbgrader config file, clone it
-            repo_path = os.path.join(self.config.user_folder_root, grader_name)
-            #TODO if there's an error cloning the repo or an unknown error when doing the initial test repo create
-            # email instructor and print a message to tell the user to create a deploy key
-            print('Checking if ' + str(repo_path) + ' is a valid course git repository')
-            repo_valid = False
-            #allow no such path or invalid repo errors; everything else should raise
-            try:
-                tmprepo = git.Repo(repo_path)
-            except git.exc.InvalidGitRepositoryError as e:
-                pass
-            except git.exc.NoSuchPathError as e:
-                pass
-            else:
-                repo_valid = True
-            if not repo_valid:
-                print(repo_path + ' is not a valid course repo. Cloning course repository from ' + self.config.instructor_repo_url)
-                if not self.dry_run:
-                    git.Repo.clone_from(self.config.instructor_repo_url, repo_path)
-                    for root, dirs, files in os.walk(repo_path):  
-                        for di in dirs:  
-                          os.chown(os.path.join(root, di), jupyter_uid, jupyter_uid)
-                        for fi in files:
-                          os.chown(os.path.join(root, fi), jupyter_uid, jupyter_uid)
-                else:
-                    print('[Dry Run: would have removed any file/folder at ' + repo_path + ', called mkdir('+repo_path+') and git clone ' + self.config.instructor_repo_url + ' into ' + repo_path)
-            else:
-                print('Repo valid.')
-
-            # if the assignment hasn't been generated yet, generate it
-            print('Checking if assignment ' + a.name + ' has been generated for grader ' + grader_name)
-            generated_asgns = self.docker.run('nbgrader db assignment list', repo_path)
-            if a.name not in generated_asgns['log']:
-                print('Assignment not yet generated. Generating')
-                output = self.docker.run('nbgrader generate_assignment --force ' + a.name, repo_path)
-                print(output['log'])
-                if 'ERROR' in output['log']:
-                    raise DockerError('Error generating assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
-            else:
-                print('Assignment already generated')
-           
-            # if solution not generated yet, generate it
-            local_path = os.path.join('source', a.name, a.name + '.ipynb')
-            soln_name = a.name + '_solution.html' 
-            print('Checking if solution generated...')
-            if not os.path.exists(os.path.join(repo_path, soln_name)):
-                print('Solution not generated; generating')
-                output = self.docker.run('jupyter nbconvert ' + local_path + ' --output=' + soln_name + ' --output-dir=.', repo_path) 
-                print(output['log'])
-                if 'ERROR' in output['log']:
-                    raise DockerError('Error generating solution for assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
+            if cloned:
+                print('Grader folder cloned from template; repo, generated assignment and solution already in place')
+                continue
+
+            self.setup_grader_repo(a, grader_name)
+
+    def create_grader_template(self, a):
+        #build the grader folder for an assignment once -- cloned repo, generated assignment and solution, right ownership --
+        #and snapshot it, so each grader folder is just a zfs clone of the snapshot
+        #the name must not contain the assignment's grader basename, or it'd be mistaken for a grader folder
+        template_name = 'rudaux-template-' + ''.join(ch for ch in a.name if ch.isalnum())
+        template_path = os.path.join(self.config.user_folder_root, template_name)
+        if os.path.exists(os.path.join(template_path, '.zfs', 'snapshot', 'ready')):
+            print('Grader template ' + template_name + ' for ' + a.name + ' already built')
+            return template_name
+        print('Building grader template ' + template_name + ' for ' + a.name)
+        if not self.zfs.user_folder_exists(template_name):
+            self.zfs.create_dataset(template_name)
+        self.setup_grader_repo(a, template_name)
+        self.zfs.snapshot_user(template_name, 'ready')
+        return template_name
+
+    def setup_grader_repo(self, a, grader_name):
+        #TODO don't hardcode 'jupyter' here
+        jupyter_uid = pwd.getpwnam('jupyter').pw_uid
+
+        # if not a valid repo with an nbgrader config file, clone it
+        repo_path = os.path.join(self.config.user_folder_root, grader_name)
+        #TODO if there's an error cloning the repo or an unknown error when doing the initial test repo create
+        # email instructor and print a message to tell the user to create a deploy key
+        print('Checking if ' + str(repo_path) + ' is a valid course git repository')
+        repo_valid = False
+        #allow no such path or invalid repo errors; everything else should raise
+        try:
+            tmprepo = git.Repo(repo_path)
+        except git.exc.InvalidGitRepositoryError as e:
+            pass
+        except git.exc.NoSuchPathError as e:
+            pass
+        else:
+            repo_valid = True
+        if not repo_valid:
+            print(repo_path + ' is not a valid course repo. Cloning course repository from ' + self.config.instructor_repo_url)
+            if not self.dry_run:
+                git.Repo.clone_from(self.config.instructor_repo_url, repo_path)
+                os.chown(repo_path, jupyter_uid, jupyter_uid)
+                for root, dirs, files in os.walk(repo_path):  
+                    for di in dirs:  
+                      os.chown(os.path.join(root, di), jupyter_uid, jupyter_uid)
+                    for fi in files:
+                      os.chown(os.path.join(root, fi), jupyter_uid, jupyter_uid)
             else:
-                print('Solution already generated')
+                print('[Dry Run: would have removed any file/folder at ' + repo_path + ', called mkdir('+repo_path+') and git clone ' + self.config.instructor_repo_url + ' into ' + repo_path)
+        else:
+            print('Repo valid.')
+
+        # if the assignment hasn't been generated yet, generate it
+        print('Checking if assignment ' + a.name + ' has been generated for grader ' + grader_name)
+        generated_asgns = self.docker.run('nbgrader db assignment list', repo_path)
+        if a.name not in generated_asgns['log']:
+            print('Assignment not yet generated. Generating')
+            output = self.docker.run('nbgrader generate_assignment --force ' + a.name, repo_path)
+            print(output['log'])
+            if 'ERROR' in output['log']:
+                raise DockerError('Error generating assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
+        else:
+            print('Assignment already generated')
+       
+        # if solution not generated yet, generate it
+        local_path = os.path.join('source', a.name, a.name + '.ipynb')
+        soln_name = a.name + '_solution.html' 
+        print('Checking if solution generated...')
+        if not os.path.exists(os.path.join(repo_path, soln_name)):
+            print('Solution not generated; generating')
+            output = self.docker.run('jupyter nbconvert ' + local_path + ' --output=' + soln_name + ' --output-dir=.', repo_path) 
+            print(output['log'])
+            if 'ERROR' in output['log']:
+                raise DockerError('Error generating solution for assignment ' + a.name + ' in grader folder ' + grader_name + ' at repo path ' + repo_path, output['log'])
+        else:
+            print('Solution already generated')
 
     def process(self, func, submissions, to_process, valid_flags):
 
@@ -406,9 +610,50 @@ class Course(object):
         for sid in to_process:
             if valid_flags is None or to_process[sid] in valid_flags:
                 results[sid] = func(submissions[sid]) 
+                submissions[sid].update_status(results[sid])
+        #save progress after every step, so the next run resumes from here even if this one dies partway through
+        self.save_submission_records([submissions[sid] for sid in results])
+        return results
+
+    def save_submission_records(self, subms):
+        if self.dry_run:
+            return
+        self.state.save_submissions({(subm.asgn.canvas_id, subm.stu.canvas_id) : subm.record() for subm in subms})
+
+    def upload_grades(self, asgn, submissions, to_process, valid_flags, failed = False):
+        #compute all the grades first, then upload them to canvas in a single batch for the assignment
+        results = self.process(lambda subm : Submission.compute_grade(subm, failed), submissions, to_process, valid_flags)
+        grades = {sid : submissions[sid].pct for sid in results if results[sid] == SubmissionStatus.DONE_GRADING}
+        print('Uploading ' + str(len(grades)) + ' grades for ' + asgn.name + ' to canvas')
+        try:
+            upload_errors = self.canvas.put_grades(asgn.canvas_id, grades)
+        except Exception as e:
+            print('Error when uploading grades for ' + asgn.name)
+            print(e)
+            upload_errors = {sid : e for sid in grades}
+        if upload_errors is None:
+            #dry run: leave the submissions at DONE_GRADING rather than marking grades uploaded that never were
+            print('[Dry Run: ' + str(len(grades)) + ' grades not uploaded; submissions not marked as uploaded]')
+            return results
+        for sid in grades:
+            results[sid] = submissions[sid].record_grade_upload(upload_errors.get(sid))
+            submissions[sid].update_status(results[sid])
+        self.save_submission_records([submissions[sid] for sid in grades])
         return results
 
     def grading_workflow(self): 
+        self.prefetch_canvas(['course_info', 'students', 'assignments'])
+
+        #get the canvas submissions for every past due assignment in one pass
+        print('Getting uploaded/posted submissions on canvas')
+        past_due_ids = [asgn.canvas_id for asgn in self.assignments if asgn.due_at < plm.now()]
+        canvas_subms = self.canvas.get_all_submissions(past_due_ids, [stu.canvas_id for stu in self.students])
+
+        #if the student datasets are local, submissions can check which snapshots exist from a single zfs list
+        #(rather than finding out by trying to copy out of each one); otherwise (e.g. over NFS) they have to try
+        snapshot_zfs = None
+        if self.config.student_folder_root.rstrip('/') == self.config.user_folder_root.rstrip('/') and self.load_snapshot_inventory():
+            snapshot_zfs = self.zfs
         
         for asgn in self.assignments:
             #only do stuff for assignments past their basic due date
@@ -442,18 +687,36 @@ class Course(object):
                     self.notifier.submit(self.config.instructor_user, 'Action Required: grader folder creation failed for ' + asgn.name+':\r\n' + error_message + '\r\n' + error_traceback)
                     continue
 
-                print('Getting uploaded/posted submissions on canvas')
-                canvas_subms = self.canvas.get_submissions(asgn.canvas_id)
-                posted_grades = {subm['student_id'] : subm['posted_at'] is not None for subm in canvas_subms} 
-                uploaded_grades = {subm['student_id'] : subm['score'] is not None for subm in canvas_subms}
+                asgn_subms = [canvas_subms[(asgn.canvas_id, stu.canvas_id)] for stu in self.students if (asgn.canvas_id, stu.canvas_id) in canvas_subms]
+                posted_grades = {subm['student_id'] : subm['posted_at'] is not None for subm in asgn_subms} 
+                uploaded_grades = {subm['student_id'] : subm['score'] is not None for subm in asgn_subms}
+
+                #submissions that were finished in a previous run (and whose grades are still uploaded and posted) need no work at all
+                records = self.state.load_submissions(asgn.canvas_id)
+                finished = {}
+                for stu in self.students:
+                    status, data = records.get((asgn.canvas_id, stu.canvas_id), (None, None))
+                    if status == SubmissionStatus.DONE and uploaded_grades[stu.canvas_id] and posted_grades[stu.canvas_id] \
+                            and data['due_date'] == self.due_dates.get_due_date(asgn, stu)[0]:
+                        finished[stu.canvas_id] = data['grader']
+                print(str(len(finished)) + ' submissions finished in previous runs; skipping them')
+                #they still count towards their graders' workloads when new submissions are assigned
+                asgn.init_grader_workloads(self.config.user_folder_root)
+                for grader in finished.values():
+                    if grader in asgn.grader_workloads:
+                        asgn.grader_workloads[grader] += 1
 
                 #create the set of submission objects for any unfinished assignments 
                 print('Creating submission objects')
                 submissions = {}
                 errors = []
                 for stu in self.students:
+                    if stu.canvas_id in finished:
+                        continue
                     try:
-                        submissions[stu.canvas_id] = Submission(asgn, stu, uploaded_grades[stu.canvas_id], posted_grades[stu.canvas_id], self.config)
+                        submissions[stu.canvas_id] = Submission(asgn, stu, uploaded_grades[stu.canvas_id], posted_grades[stu.canvas_id], self.config, self.due_dates, snapshot_zfs)
+                        if (asgn.canvas_id, stu.canvas_id) in records:
+                            submissions[stu.canvas_id].resume(records[(asgn.canvas_id, stu.canvas_id)])
                     except MultipleGraderError as e:
                         print(f'Multiple grader error in creating submission for {asgn.name} : {stu.canvas_id}')
                         print(e.message)
@@ -480,8 +743,8 @@ class Course(object):
 
                 # check if we can return the solutions to the students yet, and if so return
                 print('Checking whether solutions can be returned')
-                n_total = len(prep_results)
-                n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
+                n_total = len(prep_results) + len(finished)
+                n_outstanding = self.due_dates.count_not_due(asgn, list(prep_results.keys()), grace_hours = 1)
                 retsoln_results = {}
                 if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
                     print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
@@ -495,8 +758,7 @@ class Course(object):
 
                 #any missing assignments get a 0
                 print('Assigning 0 to all missing submissions')
-                miss_results = self.process(lambda subm: Submission.finalize_failed_submission(subm, self.canvas), submissions,
-                                               prep_results, SubmissionStatus.MISSING)
+                miss_results = self.upload_grades(asgn, submissions, prep_results, SubmissionStatus.MISSING, failed = True)
 
                 print('Submitting autograding tasks')
                 ag_results = self.process(lambda subm : Submission.submit_autograding(subm, self.docker), submissions, 
@@ -549,8 +811,7 @@ class Course(object):
                 print('Grading complete.')
 
                 print('Uploading grades')
-                ul_results = self.process(lambda subm : Submission.upload_grade(subm, self.canvas), submissions, 
-						gr_results, SubmissionStatus.DONE_GRADING)
+                ul_results = self.upload_grades(asgn, submissions, gr_results, SubmissionStatus.DONE_GRADING)
 
                 print('Submitting feedback generation tasks')
                 fb_results = self.process(lambda subm : Submission.submit_genfeedback(subm, self.docker), submissions, 
@@ -580,8 +841,8 @@ class Course(object):
                     continue
 
                 print('Checking whether feedback can be returned')
-                n_total = len(prep_results)
-                n_outstanding = len([p for p in prep_results if prep_results[p] == SubmissionStatus.NOT_DUE])
+                n_total = len(prep_results) + len(finished)
+                n_outstanding = self.due_dates.count_not_due(asgn, list(prep_results.keys()), grace_hours = 1)
                 retfdbk_results = {}
                 if (n_total - n_outstanding)/n_total >= self.config.return_solution_threshold: 
                     print('Threshold reached(' + str((n_total - n_outstanding)/n_total) + '>=' + str(self.config.return_solution_threshold)+'); this assignment is returnable')
@@ -617,6 +878,7 @@ class Course(object):
                 #if asgn past due end
             # loop over assignments end
         # func base indentation
+        self.canvas.throttle.report()
         print('Sending notifications')
         self.send_notifications()
         return
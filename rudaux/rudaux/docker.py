@@ -1,5 +1,7 @@
 import docker
 import time
+import threading
+import queue
 
 class DockerError(Exception):
     def __init__(self, message, docker_output):
@@ -9,10 +11,11 @@ class DockerError(Exception):
 class Docker(object):
 
     def __init__(self, config, dry_run):
-        self.client = docker.from_env()
+        self.n_threads = config.num_docker_threads
+        #each running container holds a connection open while we wait on it, so size the pool to fit them all
+        self.client = docker.from_env(max_pool_size = self.n_threads + 4)
         self.image = config.grading_image
         self.dry_run = dry_run
-        self.n_threads = config.num_docker_threads
         self.mem_per_thread = config.docker_memory
         self.jobs = {}
         self.job_id = 0
@@ -27,9 +30,7 @@ class Docker(object):
     def run(self, command, homedir = None):
         ctr, result = self._run_container(command, homedir)
         if ctr:
-            while ctr.status in self.runsts:
-                time.sleep(0.25)
-                ctr.reload()
+            self._wait(ctr)
             result['exit_status'] = ctr.status
             result['log'] = ctr.logs(stdout = True, stderr = True).decode('utf-8')
             ctr.remove()
@@ -41,49 +42,67 @@ class Docker(object):
         running = {}
         print_every = 30
         job_keys = [key for key in self.jobs]
+        #each running container has a thread blocked in _wait that puts the job key here when the container exits,
+        #so a free slot is refilled as soon as a job finishes (rather than on the next poll of every container)
+        finished = queue.Queue()
         while len(running) > 0 or len(job_keys) > 0:
 
-            # sleep while we have reached max threads and all running
-            time_since_print = 0
-            while len(running) >= self.n_threads and all([running[k].status in self.runsts for k in running]):
-                time.sleep(0.25)
-                time_since_print += 0.25
-                for k in running:
-                    running[k].reload()
-                if time_since_print >= print_every:
-                    print('Jobs still running: ' + str(list(running.keys())))
-                    time_since_print = 0
-
-            # refresh the status of all running containers (we may have not made it into the above loop)
-            for k in running:
-                running[k].reload()
-
-            # clean out nonrunning containers
-            to_pop = []
-            for k in running:
-                if running[k].status not in self.runsts:
-                    results[k]['exit_status'] = running[k].status
-                    results[k]['log'] = running[k].logs(stdout = True, stderr = True).decode('utf-8')
-                    running[k].remove()
-                    to_pop.append(k)
-            for k in to_pop:
-                running.pop(k, None)
-
-            # add a new container if there are any remaining
-            if len(job_keys) > 0:
-                assert len(running) < self.n_threads
+            # start containers until all threads are in use or there are no jobs left
+            while len(running) < self.n_threads and len(job_keys) > 0:
                 key = job_keys.pop()
                 print('Running ' + str(key) +': ' + self.jobs[key]['command'] + ' in ' + self.jobs[key]['homedir'])
                 results[key] = {}
                 ctr, results[key] = self._run_container(self.jobs[key]['command'], self.jobs[key]['homedir'])
                 if ctr:
                     running[key] = ctr
+                    threading.Thread(target = self._watch, args = (key, ctr, finished), daemon = True).start()
+
+            if len(running) == 0:
+                continue
+
+            # block until a container exits
+            try:
+                key = finished.get(timeout = print_every)
+            except queue.Empty:
+                print('Jobs still running: ' + str(list(running.keys())))
+                continue
+
+            # clean out the finished container
+            ctr = running.pop(key)
+            results[key]['exit_status'] = ctr.status
+            results[key]['log'] = ctr.logs(stdout = True, stderr = True).decode('utf-8')
+            ctr.remove(force = ctr.status in self.runsts)
 
         # clear the commands queue when done
         self.jobs = {} 
 
         return results
 
+    def _watch(self, key, ctr, finished):
+        #always report back, even if we lost track of the container, so run_all can't hang waiting on it
+        try:
+            self._wait(ctr)
+        except Exception as e:
+            print('Lost track of container for ' + str(key) + ': ' + str(e))
+        finally:
+            finished.put(key)
+
+    def _wait(self, ctr):
+        #block until the container exits; if waiting on it fails (e.g. the API call errors or times out), fall back to polling its status
+        try:
+            ctr.wait()
+        except Exception as e:
+            print('Waiting on container ' + str(ctr.id) + ' failed (' + str(e) + '); polling its status instead')
+            while ctr.status in self.runsts:
+                time.sleep(0.25)
+                ctr.reload()
+            return
+        #get the final status ('exited', 'dead', ...) once it's done
+        try:
+            ctr.reload()
+        except Exception:
+            pass
+
     def _run_container(self, command, homedir, n_tries = 5):
         ctr = None
         result = {}
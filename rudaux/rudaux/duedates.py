@@ -0,0 +1,49 @@
+import numpy as np
+import pendulum as plm
+
+class DueDateIndex(object):
+    """
+    Effective (i.e., accounting for overrides) due dates for every student x assignment pair, computed once per sync.
+    due[i, j] is the due date of assignment j for student i in epoch seconds (nan if there isn't one), and
+    owner[i, j] is the index of the override in self.overrides it comes from (-1 if it's the assignment's basic due date)
+    """
+
+    def __init__(self, assignments, students):
+        self.assignment_index = {a.canvas_id : j for (j, a) in enumerate(assignments)}
+        self.student_index = {s.canvas_id : i for (i, s) in enumerate(students)}
+        basic = np.array([np.nan if a.due_at is None else a.due_at.timestamp() for a in assignments], dtype=np.float64)
+        self.due = np.tile(basic, (len(students), 1))
+        self.owner = np.full((len(students), len(assignments)), -1, dtype=np.int64)
+        self.overrides = []
+
+        #same rule as Assignment.get_due_date: the latest override date applies if it's after the basic date
+        #(ties go to the first override, and a missing basic date loses to any override)
+        latest = np.where(np.isnan(self.due), -np.inf, self.due)
+        for (j, a) in enumerate(assignments):
+            for over in a.overrides:
+                if over['due_at'] is None:
+                    continue
+                rows = np.array([self.student_index[sid] for sid in over['student_ids'] if sid in self.student_index], dtype=np.int64)
+                if len(rows) == 0:
+                    continue
+                over_due = over['due_at'].timestamp()
+                rows = rows[over_due > latest[rows, j]]
+                latest[rows, j] = over_due
+                self.due[rows, j] = over_due
+                self.owner[rows, j] = len(self.overrides)
+                self.overrides.append(over)
+
+    def get_due_date(self, asgn, stu):
+        #returns the same (due date, override) pair as asgn.get_due_date(stu), without scanning the overrides
+        k = self.owner[self.student_index[stu.canvas_id], self.assignment_index[asgn.canvas_id]]
+        if k < 0:
+            return asgn.due_at, None
+        over = self.overrides[k]
+        return over['due_at'], over
+
+    def count_not_due(self, asgn, student_ids, now = None, grace_hours = 0):
+        #the number of the given students for whom the assignment is not yet due (plus a grace period)
+        now = plm.now() if now is None else now
+        rows = np.array([self.student_index[sid] for sid in student_ids], dtype=np.int64)
+        dues = self.due[rows, self.assignment_index[asgn.canvas_id]]
+        return int(np.count_nonzero(dues + 3600*grace_hours >= now.timestamp()))
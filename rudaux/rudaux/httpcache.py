@@ -0,0 +1,73 @@
+import os
+import pickle as pk
+import hashlib
+import tempfile
+import time
+
+class HTTPCache(object):
+    """
+    On-disk cache of Canvas GET responses, used to make conditional (ETag / Last-Modified) requests
+    """
+
+    def __init__(self, cache_dir, max_size_mb, max_age_days):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb*1024*1024
+        self.max_age = max_age_days*24*3600
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pk')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                return pk.load(f)
+        except (FileNotFoundError, EOFError, pk.UnpicklingError):
+            return None
+
+    def put(self, key, entry):
+        #write to a temp file and rename so that concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pk.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+
+    def touch(self, key):
+        #mark an entry as recently used (eviction removes least recently used entries first)
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def headers(self, entry):
+        #the conditional request headers for a cached entry
+        hdrs = {}
+        if entry is None:
+            return hdrs
+        if entry.get('etag') is not None:
+            hdrs['If-None-Match'] = entry['etag']
+        if entry.get('last_modified') is not None:
+            hdrs['If-Modified-Since'] = entry['last_modified']
+        return hdrs
+
+    def evict(self):
+        #remove entries not used within the max age, then the least recently used entries until under the max size
+        now = time.time()
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                os.remove(path)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+        total_size = sum([e[1] for e in entries])
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import pickle as pk
+import time
+
+class StateStore(object):
+    """
+    Persistent course state (cached canvas entities, canvas delta sync state, taken snapshots, per-submission records) in a single SQLite database.
+    The database runs in WAL mode and every write is its own transaction, so an interrupted run can't corrupt
+    what was already saved, and each piece of state is read/written individually rather than as one whole file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        #connections are used from the canvas sync threads too, so share one connection behind a lock
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS canvas_entities (name TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, taken REAL NOT NULL)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS submissions (assignment_id TEXT NOT NULL, student_id TEXT NOT NULL, status INTEGER, '
+                                  'data BLOB, updated REAL NOT NULL, PRIMARY KEY (assignment_id, student_id))')
+                #canvas delta sync state (see Canvas): processed entities with the version they were built from,
+                #the processed submissions of each assignment with the time they were last synced, and group memberships
+                self.conn.execute('CREATE TABLE IF NOT EXISTS canvas_delta (kind TEXT NOT NULL, entity_id TEXT NOT NULL, version TEXT NOT NULL, '
+                                  'data BLOB NOT NULL, PRIMARY KEY (kind, entity_id))')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS canvas_submission_watermarks (assignment_id TEXT PRIMARY KEY, watermark TEXT NOT NULL)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS canvas_submissions (assignment_id TEXT NOT NULL, student_id TEXT NOT NULL, '
+                                  'data BLOB NOT NULL, PRIMARY KEY (assignment_id, student_id))')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS canvas_groups (group_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, '
+                                  'fetched_at REAL NOT NULL, members BLOB NOT NULL)')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    #canvas entities
+
+    def load_canvas_entities(self, names = None):
+        #only unpickle the entities asked for
+        with self.lock:
+            if names is None:
+                rows = self.conn.execute('SELECT name, data FROM canvas_entities').fetchall()
+            else:
+                rows = self.conn.execute('SELECT name, data FROM canvas_entities WHERE name IN (' + ','.join('?'*len(names)) + ')', list(names)).fetchall()
+        return {name : pk.loads(data) for (name, data) in rows}
+
+    def save_canvas_entities(self, entries):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO canvas_entities (name, data, updated) VALUES (?, ?, ?)',
+                                  [(name, pk.dumps(value), now) for (name, value) in entries.items()])
+
+    #snapshots
+
+    def load_snapshots(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT name FROM snapshots ORDER BY taken, rowid').fetchall()
+        return [row[0] for row in rows]
+
+    def add_snapshots(self, names):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO snapshots (name, taken) VALUES (?, ?)', [(name, now) for name in names])
+
+    #submissions
+
+    def load_submissions(self, assignment_id = None):
+        #returns a dict of (assignment_id, student_id) : (status, data)
+        with self.lock:
+            if assignment_id is None:
+                rows = self.conn.execute('SELECT assignment_id, student_id, status, data FROM submissions').fetchall()
+            else:
+                rows = self.conn.execute('SELECT assignment_id, student_id, status, data FROM submissions WHERE assignment_id = ?', (assignment_id,)).fetchall()
+        return {(aid, sid) : (status, None if data is None else pk.loads(data)) for (aid, sid, status, data) in rows}
+
+    def save_submissions(self, records):
+        #records is a dict of (assignment_id, student_id) : (status, data); written in a single transaction
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO submissions (assignment_id, student_id, status, data, updated) VALUES (?, ?, ?, ?, ?)',
+                                  [(aid, sid, None if status is None else int(status), None if data is None else pk.dumps(data), now)
+                                   for ((aid, sid), (status, data)) in records.items()])
+
+    #canvas delta sync state
+
+    def load_canvas_delta(self, kind):
+        #returns a dict of entity_id : (version, data) for one kind of entity (e.g. enrollments)
+        with self.lock:
+            rows = self.conn.execute('SELECT entity_id, version, data FROM canvas_delta WHERE kind = ?', (kind,)).fetchall()
+        return {eid : (version, pk.loads(data)) for (eid, version, data) in rows}
+
+    def save_canvas_delta(self, kind, entries):
+        #entries is a dict of entity_id : (version, data); only these rows are written
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO canvas_delta (kind, entity_id, version, data) VALUES (?, ?, ?, ?)',
+                                  [(kind, eid, version, pk.dumps(data)) for (eid, (version, data)) in entries.items()])
+
+    def load_canvas_submissions(self, assignment_ids):
+        #returns a dict of assignment_id : {'watermark' : time of the last sync, 'subms' : {student_id : submission}}
+        #for the given assignments that have been synced before
+        marks = ','.join('?'*len(assignment_ids))
+        with self.lock:
+            watermarks = self.conn.execute('SELECT assignment_id, watermark FROM canvas_submission_watermarks WHERE assignment_id IN (' + marks + ')', list(assignment_ids)).fetchall()
+            rows = self.conn.execute('SELECT assignment_id, student_id, data FROM canvas_submissions WHERE assignment_id IN (' + marks + ')', list(assignment_ids)).fetchall()
+        synced = {aid : {'watermark' : watermark, 'subms' : {}} for (aid, watermark) in watermarks}
+        for (aid, sid, data) in rows:
+            if aid in synced:
+                synced[aid]['subms'][sid] = pk.loads(data)
+        return synced
+
+    def save_canvas_submissions(self, watermarks, subms, replaced_ids = ()):
+        #watermarks is a dict of assignment_id : time of this sync, subms a dict of (assignment_id, student_id) : submission;
+        #the submissions of the replaced assignments (those fetched in full) are dropped first. written in a single transaction,
+        #so the watermark never moves past submissions that weren't saved
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM canvas_submissions WHERE assignment_id = ?', [(aid,) for aid in replaced_ids])
+            self.conn.executemany('INSERT OR REPLACE INTO canvas_submissions (assignment_id, student_id, data) VALUES (?, ?, ?)',
+                                  [(aid, sid, pk.dumps(subm)) for ((aid, sid), subm) in subms.items()])
+            self.conn.executemany('INSERT OR REPLACE INTO canvas_submission_watermarks (assignment_id, watermark) VALUES (?, ?)',
+                                  list(watermarks.items()))
+
+    def load_canvas_groups(self):
+        #returns a dict of group_id : {'fingerprint', 'fetched_at', 'members'}
+        with self.lock:
+            rows = self.conn.execute('SELECT group_id, fingerprint, fetched_at, members FROM canvas_groups').fetchall()
+        return {gid : {'fingerprint' : fingerprint, 'fetched_at' : fetched_at, 'members' : pk.loads(members)}
+                for (gid, fingerprint, fetched_at, members) in rows}
+
+    def save_canvas_groups(self, entries, removed_ids = ()):
+        #writes the given (refetched) groups and drops the removed ones
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM canvas_groups WHERE group_id = ?', [(gid,) for gid in removed_ids])
+            self.conn.executemany('INSERT OR REPLACE INTO canvas_groups (group_id, fingerprint, fetched_at, members) VALUES (?, ?, ?, ?)',
+                                  [(gid, g['fingerprint'], g['fetched_at'], pk.dumps(g['members'])) for (gid, g) in entries.items()])
+
+    #migration from the old whole-file pickles
+
+    def migrate_pickles(self, canvas_cache_filename, snapshots_filename, submissions_filename):
+        #import each old pickle file (if there is one) in a single transaction, then move it out of the way
+        #so it isn't imported again; the old file is kept (renamed) in case it's needed
+        for (filename, importer) in [(canvas_cache_filename, self.save_canvas_entities),
+                                     (snapshots_filename, self.add_snapshots),
+                                     (submissions_filename, self._import_submissions)]:
+            if os.path.exists(filename):
+                print('Migrating ' + filename + ' into the state database ' + self.filename)
+                with open(filename, 'rb') as f:
+                    importer(pk.load(f))
+                os.replace(filename, filename + '.migrated')
+
+    def _import_submissions(self, submissions):
+        #the old submissions pickle was a dict; only entries keyed by (assignment_id, student_id) can be carried over
+        self.save_submissions({key : (None, value) for (key, value) in submissions.items() if isinstance(key, tuple) and len(key) == 2})
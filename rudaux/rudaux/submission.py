@@ -33,11 +33,14 @@ class MultipleGraderError(Exception):
 
 class Submission:
 
-    def __init__(self, asgn, stu, grade_uploaded, grade_posted, config):
+    def __init__(self, asgn, stu, grade_uploaded, grade_posted, config, due_dates = None, zfs = None):
         self.asgn = asgn
         self.stu = stu
-        self.due_date, override = asgn.get_due_date(stu)
+        #use the course's precomputed due date index if we have it
+        self.due_date, override = asgn.get_due_date(stu) if due_dates is None else due_dates.get_due_date(asgn, stu)
         self.snap_name = asgn.name if (override is None) else (asgn.name + '-override-' + override['id'])
+        #a ZFS with a loaded snapshot inventory, if the student datasets are local (None otherwise)
+        self.zfs = zfs
         self.grader_folder_root = config.user_folder_root
         self.student_folder_root = config.student_folder_root
         self.student_local_assignment_folder = config.student_local_assignment_folder
@@ -54,7 +57,57 @@ class Submission:
         self.feedback_docker_job_id = None
         self.score = None
         self.max_score = None
+        self.pct = None
         self.error = None
+        #durable progress, persisted between runs (see record/resume) so finished work isn't redone
+        self.status = None
+        self.missing = False
+        self.soln_returned = False
+        self.fdbk_returned = False
+        self.autograde_log = None
+        self.feedback_log = None
+
+    #statuses that mark work that never needs to be redone; in the order they're reached
+    durable_statuses = [SubmissionStatus.MISSING, SubmissionStatus.PREPARED, SubmissionStatus.AUTOGRADED, SubmissionStatus.DONE_GRADING,
+                        SubmissionStatus.GRADE_UPLOADED, SubmissionStatus.FEEDBACK_GENERATED, SubmissionStatus.DONE]
+
+    def reached(self, status):
+        return self.status is not None and self.status >= status
+
+    def update_status(self, status):
+        #remember the furthest durable status reached
+        if status in Submission.durable_statuses and not self.reached(status):
+            self.status = status
+        if status == SubmissionStatus.MISSING:
+            self.missing = True
+
+    def is_done(self):
+        #nothing left to do once the grade is uploaded and posted and the solution (and feedback, if it was submitted) are returned
+        return self.grade_uploaded and self.grade_posted and self.soln_returned and (self.missing or self.fdbk_returned)
+
+    def record(self):
+        if self.is_done():
+            self.update_status(SubmissionStatus.DONE)
+        return (self.status, {'due_date' : self.due_date,
+                              'grader' : self.grader,
+                              'missing' : self.missing,
+                              'score' : self.score,
+                              'max_score' : self.max_score,
+                              'pct' : self.pct,
+                              'soln_returned' : self.soln_returned,
+                              'fdbk_returned' : self.fdbk_returned,
+                              'autograde_log' : self.autograde_log,
+                              'feedback_log' : self.feedback_log})
+
+    def resume(self, record):
+        #pick up from the state saved in a previous run, unless the due date or grader has changed since
+        status, data = record
+        if data is None or data['due_date'] != self.due_date or data['grader'] != self.grader:
+            print('Saved state for submission ' + self.asgn.name+':'+self.stu.canvas_id + ' is out of date; starting over')
+            return
+        self.status = status
+        for key in ['missing', 'score', 'max_score', 'pct', 'soln_returned', 'fdbk_returned', 'autograde_log', 'feedback_log']:
+            setattr(self, key, data[key])
 
     def get_grader(self):
         graders = [username.strip('/') for username in os.listdir(self.grader_folder_root) if self.asgn.grader_basename() in username]
@@ -96,19 +149,43 @@ class Submission:
         #create the collected assignment path
         self.collected_assignment_path = os.path.join(self.grader_repo_path, self.grader_local_collection_folder, self.asgn.name + '.ipynb')
 
+        #if a previous run already collected (or found missing) this submission, there's nothing left to do here
+        if self.missing:
+            print('Submission found missing in a previous run.')
+            return SubmissionStatus.MISSING
+        if self.reached(SubmissionStatus.PREPARED):
+            print('Submission collected and cleaned in a previous run.')
+            return SubmissionStatus.PREPARED
+
+        #if the student's dataset has no snapshot, they had no folder at the due date;
+        #and if nothing was written to it between release and the due date, they didn't work on the assignment
+        #(unless it was already collected, in which case the snapshot may have been pruned since)
+        #the release snapshot only tells us that if it was taken before the assignment unlocked for this student (the earliest of
+        #the basic and their override unlock dates) -- otherwise the student may have done their work before it -- so in that case just try to collect
+        if self.zfs is not None and not os.path.exists(self.collected_assignment_path):
+            if not self.zfs.has_snapshot(self.snap_name, self.stu.canvas_id):
+                print('No snapshot ' + self.snap_name + ' for student ' + self.stu.canvas_id + '. Assignment missing.')
+                return SubmissionStatus.MISSING
+            release_snap_name = self.asgn.name + '-release'
+            release_time = self.zfs.snapshot_creation(release_snap_name, self.stu.canvas_id)
+            unlock_date = self.asgn.get_unlock_date(self.stu)
+            if (release_time is not None and unlock_date is not None and release_time <= unlock_date.timestamp()
+                    and self.zfs.written_since(release_snap_name, self.stu.canvas_id, self.snap_name) == 0):
+                print('Nothing written by student ' + self.stu.canvas_id + ' between release and snapshot ' + self.snap_name + '. Assignment missing.')
+                return SubmissionStatus.MISSING
+
         #try to collect the assignment if not already collected
         print('Collecting submission...')
         try:
             self.collect()
+        except FileNotFoundError as e:
+            print("Student did not submit on time. Assignment missing.")
+            return SubmissionStatus.MISSING
         except Exception as e: #TODO make this exception more specific and raise if unknown type
-            if "No such file" in str(e):
-                print("Student did not submit on time. Assignment missing.")
-                return SubmissionStatus.MISSING
-            else:
-                print('Error when collecting')
-                print(e)
-                self.error = e
-                return SubmissionStatus.ERROR
+            print('Error when collecting')
+            print(e)
+            self.error = e
+            return SubmissionStatus.ERROR
         else:
             print('Submission collected.')
 
@@ -128,10 +205,7 @@ class Submission:
 
     def assign(self):
         # if the grader workload dict hasn't been created in the assignment yet, create it
-        if len(self.asgn.grader_workloads) == 0:
-            graders = [username.strip('/') for username in os.listdir(self.grader_folder_root) if self.asgn.grader_basename() in username]
-            for grd in graders:
-                self.asgn.grader_workloads[grd] = 0
+        self.asgn.init_grader_workloads(self.grader_folder_root)
         # if unknown grader
         if self.grader is None:
             #assign this to the grader with the least work
@@ -204,6 +278,10 @@ class Submission:
 
         print('Autograding submission ' + self.asgn.name+':'+self.stu.canvas_id)
 
+        if self.reached(SubmissionStatus.AUTOGRADED):
+            print('Assignment autograded & validated in a previous run.')
+            return SubmissionStatus.AUTOGRADED
+
         if os.path.exists(self.autograde_fail_flag_path):
             print('Autograde failed previously. Returning')
             return SubmissionStatus.AUTOGRADE_FAILED_PREVIOUSLY
@@ -241,7 +319,12 @@ class Submission:
                 os.chown(self.autograde_fail_flag_path, jupyter_uid, jupyter_uid)
                 return SubmissionStatus.AUTOGRADE_FAILED
             print('Valid autograder result.')
+            self.autograde_log = docker_results[self.autograde_docker_job_id]['log']
             self.autograde_docker_job_id = None
+
+        if self.reached(SubmissionStatus.DONE_GRADING):
+            print('Grading for ' + self.asgn.name+':'+self.stu.canvas_id + ' finished in a previous run')
+            return SubmissionStatus.DONE_GRADING
             
         # check if the submission needs manual grading
         print('Checking whether submission ' + self.asgn.name+':'+self.stu.canvas_id + ' needs manual grading')
@@ -272,12 +355,25 @@ class Submission:
     ######################################################
 
     def upload_grade(self, canvas, failed = False):
+        status = self.compute_grade(failed)
+        if status != SubmissionStatus.DONE_GRADING:
+            return status
+        print('Posting to canvas...')
+        try:
+            canvas.put_grade(self.asgn.canvas_id, self.stu.canvas_id, self.pct)
+        except GradeNotUploadedError as e: 
+            return self.record_grade_upload(e)
+        return self.record_grade_upload(None)
+
+    def compute_grade(self, failed = False):
+        #compute the percentage grade to upload; returns DONE_GRADING if the grade is ready to upload
+        #(used to batch grade uploads for a whole assignment; see Course.upload_grades)
 
         if self.grade_uploaded:
             print('Grade already uploaded. Returning')
             return SubmissionStatus.GRADE_UPLOADED
 
-        print('Uploading grade for submission ' + self.asgn.name+':'+self.stu.canvas_id)
+        print('Computing grade for submission ' + self.asgn.name+':'+self.stu.canvas_id)
         if failed:
             score = 0
         else:
@@ -303,18 +399,19 @@ class Submission:
 
         self.score = score
         self.max_score = max_score
-        pct = "{:.2f}".format(100*score/max_score)
+        self.pct = "{:.2f}".format(100*score/max_score)
     
         print('Student ' + self.stu.canvas_id + ' assignment ' + self.asgn.name + ' score: ' + str(score) + (' [HARDFAIL]' if failed else ''))
         print('Assignment ' + self.asgn.name + ' max score: ' + str(max_score))
-        print('Pct Score: ' + pct)
-        print('Posting to canvas...')
-        try:
-            canvas.put_grade(self.asgn.canvas_id, self.stu.canvas_id, pct)
-        except GradeNotUploadedError as e: 
-            print('Error when uploading grade')
-            print(e.message)
-            self.error = e
+        print('Pct Score: ' + self.pct)
+        return SubmissionStatus.DONE_GRADING
+
+    def record_grade_upload(self, error):
+        #record the outcome of uploading the grade computed by compute_grade
+        if error is not None:
+            print('Error when uploading grade for submission ' + self.asgn.name+':'+self.stu.canvas_id)
+            print(getattr(error, 'message', error))
+            self.error = error
             return SubmissionStatus.ERROR
         self.grade_uploaded = True
         return SubmissionStatus.GRADE_UPLOADED
@@ -353,6 +450,10 @@ class Submission:
 
         print('Generating feedback for submission ' + self.asgn.name+':'+self.stu.canvas_id)
 
+        if self.reached(SubmissionStatus.FEEDBACK_GENERATED):
+            print('Feedback generated and validated in a previous run.')
+            return SubmissionStatus.FEEDBACK_GENERATED
+
         if os.path.exists(self.feedback_fail_flag_path):
             print('Feedback failed previously. Returning')
             return SubmissionStatus.FEEDBACK_FAILED_PREVIOUSLY
@@ -382,6 +483,7 @@ class Submission:
                 os.chown(self.feedback_fail_flag_path, jupyter_uid, jupyter_uid)
                 return SubmissionStatus.FEEDBACK_FAILED
             print('Valid feedback generated.')
+            self.feedback_log = docker_results[self.feedback_docker_job_id]['log']
             self.feedback_docker_job_id = None
 
         return SubmissionStatus.FEEDBACK_GENERATED
@@ -402,12 +504,17 @@ class Submission:
         fdbk_path_grader = os.path.join(self.feedback_path, self.asgn.name + '.html')
         fdbk_folder_student = os.path.join(self.student_folder_root, self.stu.canvas_id)
         fdbk_path_student = os.path.join(fdbk_folder_student, self.asgn.name + '_feedback.html')
-        if not os.path.exists(fdbk_path_student):
+        if self.fdbk_returned:
+            print('Feedback returned in a previous run.')
+        elif os.path.exists(fdbk_path_student):
+            self.fdbk_returned = True
+        else:
             if os.path.exists(fdbk_folder_student):
                 try:
                     shutil.copy(fdbk_path_grader, fdbk_path_student) 
                     jupyter_uid = pwd.getpwnam('jupyter').pw_uid
                     os.chown(fdbk_path_student, jupyter_uid, jupyter_uid)
+                    self.fdbk_returned = True
                 except Exception as e:
                     print('Error occured when returning feedback.')
                     print(e)
@@ -421,12 +528,17 @@ class Submission:
         soln_path_grader = os.path.join(self.grader_repo_path, self.asgn.name + '_solution.html')
         soln_folder_student = os.path.join(self.student_folder_root, self.stu.canvas_id)
         soln_path_student = os.path.join(soln_folder_student, self.asgn.name + '_solution.html')
-        if not os.path.exists(soln_path_student):
+        if self.soln_returned:
+            print('Solution returned in a previous run.')
+        elif os.path.exists(soln_path_student):
+            self.soln_returned = True
+        else:
             if os.path.exists(soln_folder_student):
                 try:
                     shutil.copy(soln_path_grader, soln_path_student) 
                     jupyter_uid = pwd.getpwnam('jupyter').pw_uid
                     os.chown(soln_path_student, jupyter_uid, jupyter_uid)
+                    self.soln_returned = True
                 except Exception as e:
                     print('Error occurred when returning soln.')
                     print(e)
@@ -0,0 +1,137 @@
+import threading
+import random
+import time
+import requests
+
+class Throttle(object):
+    """
+    Adaptive throttling and retry for Canvas API requests, driven by the
+    X-Rate-Limit-Remaining and X-Request-Cost headers that canvas returns with every response
+    """
+
+    def __init__(self, max_workers, max_retries, low_water = 150., high_water = 500.):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        #below high_water remaining budget, concurrency is scaled down linearly until it reaches 1 at low_water;
+        #below low_water requests are additionally paced
+        self.low_water = low_water
+        self.high_water = high_water
+        self.max_pause = 2.
+        self.remaining = None
+        #running average of the observed cost per request, used to project what the requests in flight will consume
+        self.cost = None
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.throttled_time = 0.
+        self.n_retries = 0
+
+    def projected_remaining(self):
+        #the last reported budget less what the requests still in flight are expected to cost
+        #(X-Rate-Limit-Remaining lags behind them, so with many requests in flight it overstates the budget)
+        if self.remaining is None:
+            return None
+        return self.remaining - self.in_flight*(self.cost if self.cost is not None else 0.)
+
+    def allowed_concurrency(self):
+        remaining = self.projected_remaining()
+        if remaining is None or remaining >= self.high_water:
+            return self.max_workers
+        if remaining <= self.low_water:
+            return 1
+        frac = (remaining - self.low_water)/(self.high_water - self.low_water)
+        return max(1, int(1 + frac*(self.max_workers-1)))
+
+    def pause_time(self):
+        remaining = self.projected_remaining()
+        if remaining is None or remaining >= self.low_water:
+            return 0.
+        return self.max_pause*min(1., 1. - max(0., remaining)/self.low_water)
+
+    def acquire(self):
+        #waiting for a slot only counts as throttled time while the rate limit has cut concurrency below max_workers
+        #(waiting behind our own max_workers requests is just normal contention), as does any rate limit pause
+        throttled = 0.
+        with self.cond:
+            while self.in_flight >= self.allowed_concurrency():
+                reduced = self.allowed_concurrency() < self.max_workers
+                start = time.time()
+                self.cond.wait()
+                if reduced:
+                    throttled += time.time() - start
+            self.in_flight += 1
+            pause = self.pause_time()
+        if pause > 0:
+            time.sleep(pause)
+            throttled += pause
+        if throttled > 0:
+            self._add_throttled_time(throttled)
+
+    def release(self, resp):
+        with self.cond:
+            self.in_flight -= 1
+            if resp is not None and resp.headers.get('X-Rate-Limit-Remaining') is not None:
+                try:
+                    self.remaining = float(resp.headers['X-Rate-Limit-Remaining'])
+                except ValueError:
+                    pass
+            if resp is not None and resp.headers.get('X-Request-Cost') is not None:
+                try:
+                    cost = float(resp.headers['X-Request-Cost'])
+                except ValueError:
+                    pass
+                else:
+                    self.cost = cost if self.cost is None else 0.8*self.cost + 0.2*cost
+            self.cond.notify_all()
+
+    def _add_throttled_time(self, t):
+        with self.cond:
+            self.throttled_time += t
+
+    def should_retry(self, resp):
+        #canvas signals throttling with a 403 (and sometimes 429); 5xx gateway errors are usually transient
+        if resp.status_code == 403 and 'Rate Limit Exceeded' in resp.text:
+            return True
+        return resp.status_code in [429, 500, 502, 503, 504]
+
+    def backoff_time(self, attempt, resp):
+        if resp is not None and resp.headers.get('Retry-After') is not None:
+            try:
+                return float(resp.headers['Retry-After'])
+            except ValueError:
+                pass
+        #jittered exponential backoff
+        return min(60., 2.**attempt)*random.uniform(0.5, 1.5)
+
+    def request(self, func, retry = True, **kwargs):
+        #make a request through the throttle; if retry is True, throttled / transient failures are retried with backoff
+        attempt = 0
+        while True:
+            resp = None
+            error = None
+            self.acquire()
+            try:
+                resp = func(**kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            finally:
+                self.release(resp)
+
+            if resp is not None and not self.should_retry(resp):
+                return resp
+            if not retry or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return resp
+
+            delay = self.backoff_time(attempt, resp)
+            print('Canvas request to ' + str(kwargs.get('url')) + ' failed (' + (str(resp.status_code) if resp is not None else str(error)) + '); retrying in ' + '{:.1f}'.format(delay) + 's')
+            time.sleep(delay)
+            self._add_throttled_time(delay)
+            with self.cond:
+                self.n_retries += 1
+            attempt += 1
+
+    def report(self):
+        print('Canvas throttling: ' + str(self.n_retries) + ' retries, ' + '{:.1f}'.format(self.throttled_time) + 's spent waiting' +
+              ('' if self.remaining is None else ', rate limit remaining ' + '{:.0f}'.format(self.remaining)) +
+              ('' if self.cost is None else ', average request cost ' + '{:.1f}'.format(self.cost)))
@@ -1,5 +1,12 @@
-from subprocess import check_output, STDOUT
+from subprocess import check_output, STDOUT, CalledProcessError
 import os
+import time
+import re
+import json
+import shutil
+
+#zfs user property set on every snapshot rudaux takes (value: the course name), so rudaux can tell its snapshots apart from others
+OWNER_PROPERTY = 'rudaux:course'
 
 class ZFS(object):
     """
@@ -9,25 +16,218 @@ class ZFS(object):
     def __init__(self, config, dry_run):
         self.user_folder_root = config.user_folder_root
         self.jupyterhub_config_dir = config.jupyterhub_config_dir
+        self.course_name = config.name
         self.dry_run = dry_run
+        self.root_dataset = self.user_folder_root.strip('/')
+        #properties for the datasets rudaux creates itself (grader templates and their clones), matching ZFSOPTS in zfs_homedir.sh
+        #(clones don't inherit properties set locally on their origin, so they have to be given explicitly)
+        self.dataset_options = config.get('zfs_dataset_options', {'refquota' : '2G'})
+        #dataset name : {snapshot name : {'creation' : epoch seconds, 'owner' : rudaux course name or None}}
+        #for the user folder root and every dataset under it; loaded with a single zfs list (see load_inventory)
+        self.inventory = None
+        #release snapshot name : {(user, snapshot name) : bytes written}; see written_since
+        self.written = {}
+
+    def dataset(self, user = None):
+        return self.root_dataset if user is None else os.path.join(self.user_folder_root, user).strip('/')
 
     def snapshot_all(self, snap_name):
-        cmd_list = ['/usr/sbin/zfs', 'snapshot', '-r', self.user_folder_root.strip('/') + '@'+snap_name]
+        cmd_list = ['/usr/sbin/zfs', 'snapshot', '-r', '-o', OWNER_PROPERTY + '=' + self.course_name, self.dataset() + '@'+snap_name]
         if not self.dry_run:
             check_output(cmd_list, stderr=STDOUT)
+            self._add_to_inventory([ds for ds in self.inventory or [] if ds == self.root_dataset or ds.startswith(self.root_dataset + '/')], snap_name)
         else:
             print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
 
     def snapshot_user(self, user, snap_name):
-        cmd_list = ['/usr/sbin/zfs', 'snapshot', os.path.join(self.user_folder_root, user).strip('/') + '@'+snap_name]
+        cmd_list = ['/usr/sbin/zfs', 'snapshot', '-o', OWNER_PROPERTY + '=' + self.course_name, self.dataset(user) + '@'+snap_name]
         if not self.dry_run:
             check_output(cmd_list, stderr=STDOUT)
+            self._add_to_inventory([self.dataset(user)], snap_name)
         else:
             print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
 
+    def snapshot_batch(self, snapshots, recursive = False):
+        #create many snapshots (a list of (user or None for the root dataset, snapshot name)) with as few zfs calls as possible
+        #returns a dict of (user, snapshot name) : zfs error output for the snapshots that couldn't be created
+        failed = {}
+        for batch in self.snapshot_rounds(snapshots, recursive):
+            failed.update(self._snapshot_call(batch, recursive))
+        return failed
+
+    def snapshot_rounds(self, snapshots, recursive = False):
+        #zfs refuses to take more than one snapshot of the same filesystem in one call, so split the snapshots
+        #into rounds that each have any dataset at most once; a recursive snapshot covers every dataset under the root,
+        #so each recursive snapshot name gets its own call
+        if recursive:
+            return [[snap] for snap in dict.fromkeys(snapshots)]
+        rounds = []
+        counts = {}
+        for (user, snap_name) in dict.fromkeys(snapshots):
+            k = counts.get(user, 0)
+            counts[user] = k + 1
+            if k == len(rounds):
+                rounds.append([])
+            rounds[k].append((user, snap_name))
+        return rounds
+
+    def _snapshot_call(self, snapshots, recursive):
+        #zfs snapshot creates all the names it's given atomically, so if any fail, none are created -- in that case,
+        #pick out the failed names from zfs's output and try the rest again
+        #zfs reports a bad name either as "cannot create snapshot '<ds>@<snap>': ..." or, for a dataset that doesn't exist,
+        #as "cannot open '<ds>': ..." (followed by the usage text, and only for the first such dataset)
+        pending = {self.dataset(user) + '@' + snap_name : (user, snap_name) for (user, snap_name) in snapshots}
+        failed = {}
+        while len(pending) > 0:
+            if self.dry_run:
+                print('[Dry run: would have called: ' + ' '.join(self._snapshot_cmd(list(pending.keys()), recursive)) + ']')
+                break
+            try:
+                self._run_snapshot(list(pending.keys()), recursive)
+            except CalledProcessError as e:
+                output = e.output.decode('utf-8')
+                errors = {}
+                for line in output.splitlines():
+                    match = re.match("cannot create snapshots? '([^']+)': (.*)", line)
+                    if match is not None and match.group(1) in pending:
+                        errors[match.group(1)] = line
+                        continue
+                    match = re.match("cannot open '([^']+)': (.*)", line)
+                    if match is not None:
+                        for name in pending:
+                            if name.partition('@')[0] == match.group(1):
+                                errors[name] = line
+                if len(errors) == 0:
+                    #can't tell which snapshot(s) caused the failure, so they all fail rather than guessing
+                    failed.update({pending[name] : output for name in pending})
+                    break
+                #the other names weren't necessarily at fault (zfs stops at the first dataset it can't open), so try them again
+                for name in errors:
+                    failed[pending.pop(name)] = errors[name]
+            else:
+                for (user, snap_name) in pending.values():
+                    if recursive:
+                        root = self.dataset(user)
+                        self._add_to_inventory([ds for ds in self.inventory or [] if ds == root or ds.startswith(root + '/')], snap_name)
+                    else:
+                        self._add_to_inventory([self.dataset(user)], snap_name)
+                break
+        return failed
+
+    def _snapshot_cmd(self, names, recursive):
+        return ['/usr/sbin/zfs', 'snapshot'] + (['-r'] if recursive else []) + ['-o', OWNER_PROPERTY + '=' + self.course_name] + names
+
+    def _run_snapshot(self, names, recursive):
+        #one zfs snapshot call for the given <dataset>@<snapshot> names
+        check_output(self._snapshot_cmd(names, recursive), stderr=STDOUT)
+
+    def missing_dataset_error(self, error, user = None):
+        #whether a snapshot_batch error for the user's snapshot says that the user's own dataset doesn't exist
+        return re.match("cannot (open|create snapshots?) '" + re.escape(self.dataset(user)) + "(@[^']*)?': dataset does not exist", error) is not None
+
     def list_snapshots(self):
         print(check_output(['/usr/sbin/zfs', 'list', '-t', 'snapshot'], stderr = STDOUT))
 
+    def load_inventory(self):
+        #one zfs list call for every dataset and snapshot under the user folder root (rather than probing datasets one at a time)
+        cmd_list = ['/usr/sbin/zfs', 'list', '-H', '-p', '-t', 'filesystem,snapshot', '-o', 'name,creation,' + OWNER_PROPERTY, '-r', self.root_dataset]
+        output = check_output(cmd_list, stderr=STDOUT).decode('utf-8')
+        inventory = {}
+        for line in output.splitlines():
+            name, creation, owner = line.split('\t')
+            dataset, _, snap_name = name.partition('@')
+            snaps = inventory.setdefault(dataset, {})
+            if snap_name:
+                snaps[snap_name] = {'creation' : int(creation), 'owner' : None if owner == '-' else owner}
+        self.inventory = inventory
+        return inventory
+
+    def written_since(self, base_snap_name, user, snap_name):
+        #bytes written to the user's dataset between the base snapshot and the named snapshot, or None if unknown
+        #(e.g. the dataset has no base snapshot); one zfs get for all snapshots of all datasets per base snapshot
+        if base_snap_name not in self.written:
+            cmd_list = ['/usr/sbin/zfs', 'get', '-H', '-p', '-r', '-t', 'snapshot', '-o', 'name,value', 'written@' + base_snap_name, self.root_dataset]
+            try:
+                output = check_output(cmd_list, stderr=STDOUT).decode('utf-8')
+            except CalledProcessError as e:
+                #zfs complains about datasets without the base snapshot, but still reports the others
+                output = e.output.decode('utf-8')
+            written = {}
+            for line in output.splitlines():
+                fields = line.split('\t')
+                if len(fields) != 2 or not fields[1].isdigit():
+                    continue
+                dataset, _, snap = fields[0].partition('@')
+                if dataset.startswith(self.root_dataset + '/'):
+                    written[(dataset[len(self.root_dataset)+1:], snap)] = int(fields[1])
+            self.written[base_snap_name] = written
+        return self.written[base_snap_name].get((user, snap_name))
+
+    def destroy_plan(self, prunable):
+        #work out the zfs destroy arguments for a dict of dataset : names of snapshots to destroy
+        #snapshot names that are prunable on every dataset that has them (including the root) go in one recursive destroy;
+        #the rest are destroyed per dataset, with runs of consecutive snapshots given as snap1%snapN ranges
+        #returns a list of (recursive, argument) pairs
+        plan = []
+        recursive = [snap_name for snap_name in self.inventory.get(self.root_dataset, {})
+                     if all([snap_name in prunable.get(ds, ()) for ds in self.inventory if snap_name in self.inventory[ds]])]
+        if len(recursive) > 0:
+            plan.append((True, self.root_dataset + '@' + ','.join(recursive)))
+        for ds in prunable:
+            names = set(prunable[ds]).difference(recursive)
+            if len(names) == 0:
+                continue
+            #snapshots in creation order (stable, so zfs list order breaks ties)
+            ordered = sorted(self.inventory[ds], key = lambda snap_name : self.inventory[ds][snap_name]['creation'])
+            runs = []
+            run = []
+            for snap_name in ordered + [None]:
+                if snap_name in names:
+                    run.append(snap_name)
+                elif len(run) > 0:
+                    runs.append(run[0] if len(run) == 1 else run[0] + '%' + run[-1])
+                    run = []
+            plan.append((False, ds + '@' + ','.join(runs)))
+        return plan
+
+    def destroy_snapshots(self, prunable):
+        #destroy the snapshots in a dict of dataset : snapshot names, in as few zfs destroy calls as possible
+        #returns a dict of zfs destroy argument : error output for any calls that failed
+        failed = {}
+        for (recursive, arg) in self.destroy_plan(prunable):
+            cmd_list = ['/usr/sbin/zfs', 'destroy'] + (['-r'] if recursive else []) + [arg]
+            if self.dry_run:
+                print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
+                continue
+            try:
+                check_output(cmd_list, stderr=STDOUT)
+            except CalledProcessError as e:
+                failed[arg] = e.output.decode('utf-8')
+        if not self.dry_run:
+            #zfs is the authority on what's left; re-list rather than trying to track partial failures
+            self.load_inventory()
+        return failed
+
+    def _add_to_inventory(self, datasets, snap_name):
+        #keep the in-memory inventory up to date with snapshots we just took
+        if self.inventory is None:
+            return
+        now = int(time.time())
+        for ds in datasets:
+            self.inventory.setdefault(ds, {})[snap_name] = {'creation' : now, 'owner' : self.course_name}
+
+    def dataset_exists(self, user = None):
+        return self.dataset(user) in self.inventory
+
+    def has_snapshot(self, snap_name, user = None):
+        #whether the user's dataset (or the root dataset if user is None) has the named snapshot, according to the inventory
+        return snap_name in self.inventory.get(self.dataset(user), {})
+
+    def snapshot_creation(self, snap_name, user = None):
+        #creation time (epoch seconds) of the named snapshot of the user's dataset according to the inventory, or None if it doesn't have it
+        snap = self.inventory.get(self.dataset(user), {}).get(snap_name)
+        return None if snap is None else snap['creation']
+
     def create_user_folder(self, username):
         callysto_user = 'jupyter'
         course = 'dsci100'
@@ -37,5 +237,231 @@ class ZFS(object):
         else:
             print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
 
+    def create_dataset(self, username):
+        #a plain dataset under the user folder root (e.g. for a grader template; see Course.create_grader_template)
+        cmd_list = ['/usr/sbin/zfs', 'create'] + self._option_args() + [self.dataset(username)]
+        if not self.dry_run:
+            check_output(cmd_list, stderr=STDOUT)
+        else:
+            print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
+
+    def clone_user_folder(self, template_name, snap_name, username):
+        #create a user folder as a (copy on write) clone of a snapshot of another folder, contents and ownership included
+        cmd_list = ['/usr/sbin/zfs', 'clone'] + self._option_args() + [self.dataset(template_name) + '@' + snap_name, self.dataset(username)]
+        if not self.dry_run:
+            check_output(cmd_list, stderr=STDOUT)
+        else:
+            print('[Dry run: would have called: ' + ' '.join(cmd_list) + ']')
+
     def user_folder_exists(self, username):
         return os.path.exists(os.path.join(self.user_folder_root, username).rstrip('/'))
+
+    def _option_args(self):
+        return [arg for (key, value) in self.dataset_options.items() for arg in ['-o', key + '=' + str(value)]]
+
+#what zfs snapshot prints after an argument error
+FAKE_SNAPSHOT_USAGE = """usage:
+\tsnapshot [-r] [-o property=value] ... <filesystem|volume>@<snap> ...
+
+For the property list, run: zfs set|get
+
+For the delegated permission list, run: zfs allow|unallow
+"""
+
+class FakeZFS(ZFS):
+    """
+    Stand-in for the ZFS interface that emulates datasets and snapshots with plain directories, for running/benchmarking
+    rudaux on a machine without a zfs pool (set c.storage_backend = 'fake' and point user_folder_root at e.g. a temp directory)
+    The user folder root and each folder directly under it is a "dataset"; a snapshot of one is a copy of its contents
+    in <folder>/.zfs/snapshot/<snapshot name> (so snapshot paths look just like they do on zfs), and snapshot properties
+    are kept in <folder>/.zfs/snapshots.json
+    """
+
+    def __init__(self, config, dry_run):
+        super().__init__(config, dry_run)
+        #'hardlink' (fast, but a file modified in place -- rather than replaced -- changes in its snapshots too),
+        #or 'copy' (cp --reflink=auto; a real copy unless the filesystem supports reflinks)
+        self.copy_mode = config.get('fake_zfs_copy_mode', 'hardlink')
+
+    def folder(self, user = None):
+        return self.user_folder_root.rstrip('/') if user is None else os.path.join(self.user_folder_root, user)
+
+    def _child_users(self):
+        return sorted([name for name in os.listdir(self.folder()) if name != '.zfs' and os.path.isdir(self.folder(name))])
+
+    def _load_properties(self, user):
+        try:
+            with open(os.path.join(self.folder(user), '.zfs', 'snapshots.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_properties(self, user, props):
+        filename = os.path.join(self.folder(user), '.zfs', 'snapshots.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(props, f)
+        os.replace(filename + '.tmp', filename)
+
+    def _dataset_snapshots(self, user):
+        #snapshot name : properties for a dataset, in creation order
+        snap_root = os.path.join(self.folder(user), '.zfs', 'snapshot')
+        if not os.path.isdir(snap_root):
+            return {}
+        props = self._load_properties(user)
+        order = {snap_name : k for (k, snap_name) in enumerate(props)}
+        snaps = {}
+        for snap_name in os.listdir(snap_root):
+            snaps[snap_name] = props.get(snap_name, {'creation' : int(os.path.getmtime(os.path.join(snap_root, snap_name))), 'owner' : None})
+        #ties (snapshots taken in the same second) keep the order they were taken in
+        return dict(sorted(snaps.items(), key = lambda item : (item[1]['creation'], order.get(item[0], len(order)))))
+
+    def _copy_tree(self, src, dst, names, link):
+        #copy the named entries of src into dst (hardlinking files, or cp --reflink=auto)
+        os.makedirs(dst)
+        if len(names) == 0:
+            return
+        if link:
+            def link_or_copy(s, d):
+                try:
+                    os.link(s, d)
+                except OSError:
+                    shutil.copy2(s, d)
+            for name in names:
+                path = os.path.join(src, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.copytree(path, os.path.join(dst, name), symlinks = True, copy_function = link_or_copy)
+                else:
+                    link_or_copy(path, os.path.join(dst, name))
+        else:
+            check_output(['cp', '-a', '--reflink=auto'] + [os.path.join(src, name) for name in names] + [dst], stderr=STDOUT)
+
+    def _snapshot(self, user, snap_name):
+        #the root dataset's snapshot doesn't include its child datasets, just like on zfs
+        src = self.folder(user)
+        names = [name for name in os.listdir(src) if name != '.zfs' and (user is not None or not os.path.isdir(os.path.join(src, name)))]
+        self._copy_tree(src, os.path.join(src, '.zfs', 'snapshot', snap_name), names, self.copy_mode == 'hardlink')
+        props = self._load_properties(user)
+        props[snap_name] = {'creation' : int(time.time()), 'owner' : self.course_name}
+        self._save_properties(user, props)
+
+    def snapshot_all(self, snap_name):
+        failed = self.snapshot_batch([(None, snap_name)], recursive = True)
+        if len(failed) > 0:
+            raise CalledProcessError(1, ['snapshot', '-r', self.dataset() + '@' + snap_name], output = list(failed.values())[0].encode('utf-8'))
+
+    def snapshot_user(self, user, snap_name):
+        failed = self.snapshot_batch([(user, snap_name)])
+        if len(failed) > 0:
+            raise CalledProcessError(1, ['snapshot', self.dataset(user) + '@' + snap_name], output = list(failed.values())[0].encode('utf-8'))
+
+    def _run_snapshot(self, names, recursive):
+        #emulates one zfs snapshot call, failing (without creating anything) the way zfs does, with zfs's error output:
+        #a dataset that doesn't exist, more than one snapshot of a dataset in the call, or a snapshot that already exists
+        #(a recursive snapshot fails if any dataset it covers already has it)
+        covered = {}
+        for name in names:
+            ds, _, snap_name = name.partition('@')
+            user = None if ds == self.root_dataset else ds[len(self.root_dataset)+1:]
+            if not os.path.isdir(self.folder(user)):
+                raise CalledProcessError(2, self._snapshot_cmd(names, recursive), output = ("cannot open '" + ds + "': dataset does not exist\n" + FAKE_SNAPSHOT_USAGE).encode('utf-8'))
+            covered[name] = (snap_name, [user] + (self._child_users() if recursive and user is None else []))
+        datasets = [u for (snap_name, users) in covered.values() for u in users]
+        if len(set(datasets)) < len(datasets):
+            raise CalledProcessError(1, self._snapshot_cmd(names, recursive), output = b'cannot create snapshots : multiple snapshots of same fs not allowed\n')
+        existing = [self.dataset(u) + '@' + snap_name for (snap_name, users) in covered.values() for u in users
+                    if os.path.exists(os.path.join(self.folder(u), '.zfs', 'snapshot', snap_name))]
+        if len(existing) > 0:
+            raise CalledProcessError(1, self._snapshot_cmd(names, recursive),
+                                     output = (''.join(["cannot create snapshot '" + name + "': dataset already exists\n" for name in existing]) + 'no snapshots were created\n').encode('utf-8'))
+        for (name, (snap_name, users)) in covered.items():
+            try:
+                for u in users:
+                    self._snapshot(u, snap_name)
+            except OSError as e:
+                raise CalledProcessError(1, self._snapshot_cmd(names, recursive), output = ("cannot create snapshot '" + name + "': " + str(e) + '\n').encode('utf-8'))
+
+    def list_snapshots(self):
+        for (ds, snaps) in self.load_inventory().items():
+            for snap_name in snaps:
+                print(ds + '@' + snap_name)
+
+    def load_inventory(self):
+        inventory = {self.dataset() : self._dataset_snapshots(None)}
+        for user in self._child_users():
+            inventory[self.dataset(user)] = self._dataset_snapshots(user)
+        self.inventory = inventory
+        return inventory
+
+    def written_since(self, base_snap_name, user, snap_name):
+        #emulates the zfs written@ property: the size (rounded up to 512 byte sectors, at least one per file)
+        #of every file added, changed or removed between the two snapshots; computed on demand for each snapshot
+        written = self.written.setdefault(base_snap_name, {})
+        if (user, snap_name) not in written:
+            snap_root = os.path.join(self.folder(user), '.zfs', 'snapshot')
+            base, snap = os.path.join(snap_root, base_snap_name), os.path.join(snap_root, snap_name)
+            if not os.path.isdir(base) or not os.path.isdir(snap):
+                return None
+            base_files, snap_files = self._file_stats(base), self._file_stats(snap)
+            total = 0
+            for path in set(base_files).union(snap_files):
+                b, s = base_files.get(path), snap_files.get(path)
+                if b is not None and s is not None and (b.st_ino == s.st_ino or (b.st_size == s.st_size and b.st_mtime_ns == s.st_mtime_ns)):
+                    continue
+                total += 512*max(1, ((s or b).st_size + 511)//512)
+            written[(user, snap_name)] = total
+        return written[(user, snap_name)]
+
+    def _file_stats(self, root):
+        stats = {}
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                stats[os.path.relpath(path, root)] = os.lstat(path)
+        return stats
+
+    def destroy_snapshots(self, prunable):
+        #no need for destroy_plan's batching here; just remove each snapshot directory
+        failed = {}
+        for (ds, snap_names) in prunable.items():
+            user = None if ds == self.root_dataset else ds[len(self.root_dataset)+1:]
+            if self.dry_run:
+                print('[Dry run: would have destroyed fake snapshots ' + ds + '@' + ','.join(snap_names) + ']')
+                continue
+            props = self._load_properties(user)
+            for snap_name in snap_names:
+                try:
+                    shutil.rmtree(os.path.join(self.folder(user), '.zfs', 'snapshot', snap_name))
+                except OSError as e:
+                    failed[ds + '@' + snap_name] = str(e)
+                    continue
+                props.pop(snap_name, None)
+            self._save_properties(user, props)
+        if not self.dry_run:
+            self.load_inventory()
+        return failed
+
+    def create_user_folder(self, username):
+        #zfs_homedir.sh also sets up ownership; here the folder just belongs to whoever runs rudaux
+        self.create_dataset(username)
+
+    def create_dataset(self, username):
+        if not self.dry_run:
+            os.makedirs(os.path.join(self.folder(username), '.zfs', 'snapshot'))
+            if self.inventory is not None:
+                self.inventory[self.dataset(username)] = {}
+        else:
+            print('[Dry run: would have created fake dataset ' + self.folder(username) + ']')
+
+    def clone_user_folder(self, template_name, snap_name, username):
+        #a clone is writable, so it's always a real (or reflinked) copy of the snapshot, never hardlinks
+        src = os.path.join(self.folder(template_name), '.zfs', 'snapshot', snap_name)
+        if not self.dry_run:
+            if not os.path.isdir(src):
+                raise CalledProcessError(1, ['clone', self.dataset(template_name) + '@' + snap_name, self.dataset(username)],
+                                         output = ("cannot open '" + self.dataset(template_name) + '@' + snap_name + "': dataset does not exist").encode('utf-8'))
+            self._copy_tree(src, self.folder(username), os.listdir(src), False)
+            os.makedirs(os.path.join(self.folder(username), '.zfs', 'snapshot'))
+            if self.inventory is not None:
+                self.inventory[self.dataset(username)] = {}
+        else:
+            print('[Dry run: would have cloned fake snapshot ' + src + ' to ' + self.folder(username) + ']')
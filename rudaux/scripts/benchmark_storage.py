@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Benchmarks the snapshot/collection path of rudaux against the fake (directory-backed) zfs backend,
+# on a synthetic set of student folders in a temp directory -- no zfs pool needed:
+#   python3 benchmark_storage.py --students 5000 --edited 0.8
+# Two assignments are released and come due in the same pass. Each phase (creating folders, release/due snapshots,
+# listing the inventory, the written@ check, collecting the submitted notebooks out of the snapshots, pruning) is timed separately.
+# Run it from the repository root, or with rudaux installed.
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tempfile
+from argparse import ArgumentParser
+from traitlets.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rudaux.zfs import FakeZFS
+
+def make_notebook(n_cells, text):
+    return {'cells' : [{'cell_type' : 'code', 'metadata' : {'nbgrader' : {'grade_id' : 'cell-' + str(k)}},
+                        'source' : text + str(k), 'outputs' : [], 'execution_count' : None} for k in range(n_cells)],
+            'metadata' : {}, 'nbformat' : 4, 'nbformat_minor' : 4}
+
+def write_notebook(path, nb):
+    #write to a new file and rename it over the old one, like jupyter does
+    with open(path + '.tmp', 'w') as f:
+        json.dump(nb, f)
+    os.replace(path + '.tmp', path)
+
+class Timer(object):
+    def __init__(self, name, n):
+        self.name = name
+        self.n = n
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        print(self.name.ljust(28) + ('%.2f s' % elapsed).rjust(10) + ('%.0f / s' % (self.n/elapsed if elapsed > 0 else float('inf'))).rjust(14), flush=True)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Time snapshotting and collection with the fake zfs backend on synthetic student folders.')
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--edited', type=float, default=0.8, help='fraction of students who work on the assignment')
+    parser.add_argument('--cells', type=int, default=40, help='number of cells in the assignment notebook')
+    parser.add_argument('--copy-mode', dest='copy_mode', default='hardlink', choices=['hardlink', 'copy'])
+    parser.add_argument('--dir', default=None, help='where to create the benchmark directory (default: the system temp directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the folders afterwards')
+    args = parser.parse_args()
+
+    root = os.path.join(tempfile.mkdtemp(prefix='rudaux-bench-', dir=args.dir), 'home')
+    collection = os.path.join(os.path.dirname(root), 'collected')
+    os.makedirs(root)
+    os.makedirs(collection)
+    c = Config()
+    c.name = 'bench'
+    c.user_folder_root = root
+    c.jupyterhub_config_dir = root
+    c.fake_zfs_copy_mode = args.copy_mode
+    zfs = FakeZFS(c, False)
+
+    #two assignments released and due in the same pass, so each pass snapshots several names at once
+    asgns = ['worksheet_1', 'worksheet_2']
+    folders = {asgn : os.path.join('dsci-100', 'materials', asgn) for asgn in asgns}
+    students = [str(1000+i) for i in range(args.students)]
+    edited = set(random.Random(0).sample(students, int(args.edited*len(students))))
+    released = make_notebook(args.cells, '# your code here ')
+    print('Benchmarking ' + str(len(students)) + ' students (' + str(len(edited)) + ' working on ' + ', '.join(asgns) + ') in ' + root + ' with copy mode ' + args.copy_mode)
+
+    with Timer('create folders', len(students)):
+        for sid in students:
+            zfs.create_user_folder(sid)
+            for asgn in asgns:
+                os.makedirs(os.path.join(root, sid, folders[asgn]))
+                write_notebook(os.path.join(root, sid, folders[asgn], asgn + '.ipynb'), released)
+    with Timer('release snapshots', len(asgns)*len(students)):
+        failed = zfs.snapshot_batch([(None, asgn + '-release') for asgn in asgns], recursive = True)
+    for sid in edited:
+        for asgn in asgns:
+            write_notebook(os.path.join(root, sid, folders[asgn], asgn + '.ipynb'), make_notebook(args.cells, '# answer from ' + sid + ' '))
+    with Timer('due date snapshots', len(asgns)*len(students)):
+        failed.update(zfs.snapshot_batch([(None, asgn) for asgn in asgns], recursive = True))
+    with Timer('load inventory', len(students)):
+        zfs.load_inventory()
+    with Timer('written@ check', len(asgns)*len(students)):
+        untouched = [(asgn, sid) for asgn in asgns for sid in students if zfs.written_since(asgn + '-release', sid, asgn) == 0]
+    with Timer('collect', len(asgns)*len(students) - len(untouched)):
+        for asgn in asgns:
+            for sid in set(students).difference([s for (a, s) in untouched if a == asgn]):
+                shutil.copy(os.path.join(root, sid, '.zfs', 'snapshot', asgn, folders[asgn], asgn + '.ipynb'), os.path.join(collection, asgn + '-' + sid + '.ipynb'))
+    with Timer('prune', 2*len(asgns)*len(students)):
+        failed_destroy = zfs.destroy_snapshots({ds : list(snaps) for (ds, snaps) in zfs.inventory.items() if len(snaps) > 0})
+
+    print('Snapshot failures: ' + str(len(failed)) + ', destroy failures: ' + str(len(failed_destroy)))
+    print('Untouched submissions found: ' + str(len(untouched)) + ' (expected ' + str(len(asgns)*(len(students) - len(edited))) + ')')
+    if not args.keep:
+        shutil.rmtree(os.path.dirname(root))
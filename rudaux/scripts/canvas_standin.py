@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the parts of the Canvas REST and GraphQL APIs that rudaux reads,
+# serving a synthetic course. Useful for exercising/benchmarking the canvas backends without a real course:
+#   python3 canvas_standin.py --port 8765 --students 1500 --assignments 20 --groups 300
+# then point a rudaux_config.py at it with
+#   c.canvas_domain = 'http://localhost:8765'
+#   c.canvas_id = '1'
+#   c.jupyterhub_host_root = 'hub.example.com'
+# The number of requests served is printed as they come in.
+
+import json
+import re
+import hashlib
+import threading
+import urllib.parse
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def make_course(n_students, n_assignments, n_groups, hub_root):
+    date = '2020-09-01T07:00:00Z'
+    students = [{'id' : 1000+i, 'name' : 'Student ' + str(i), 'sortable_name' : str(i) + ', Student',
+                 'short_name' : 'Student ' + str(i), 'sis_user_id' : str(90000000+i)} for i in range(n_students)]
+    enrollments = [{'id' : 5000+i, 'type' : 'StudentEnrollment', 'enrollment_state' : 'active', 'created_at' : date,
+                    'updated_at' : date, 'user' : s} for (i, s) in enumerate(students)]
+    assignments = [{'id' : 200+j, 'name' : 'worksheet_' + str(j), 'due_at' : '2020-10-' + str(1+j%28).zfill(2) + 'T06:59:59Z',
+                    'lock_at' : None, 'unlock_at' : date, 'points_possible' : 10, 'grading_type' : 'points',
+                    'workflow_state' : 'published', 'has_overrides' : False, 'published' : True, 'updated_at' : date,
+                    'omit_from_final_grade' : False, 'overrides' : [],
+                    'external_tool_tag_attributes' : {'url' : 'https://' + hub_root + '/hub/lti/launch'}} for j in range(n_assignments)]
+    submissions = {str(a['id']) : [{'assignment_id' : a['id'], 'user_id' : s['id'], 'grade' : None, 'score' : None,
+                                    'workflow_state' : 'unsubmitted', 'excused' : False, 'late_policy_status' : None,
+                                    'points_deducted' : None, 'posted_at' : None, 'late' : False, 'missing' : True,
+                                    'entered_grade' : None, 'entered_score' : None, 'graded_at' : None, 'submitted_at' : None}
+                                   for s in students] for a in assignments}
+    groups = [{'id' : 7000+k, 'name' : 'Group ' + str(k), 'members' : [s['id'] for s in students[k::max(n_groups, 1)]]} for k in range(n_groups)]
+    return {'info' : {'id' : 1, 'name' : 'Stand-in course', 'time_zone' : 'America/Vancouver'},
+            'enrollments' : enrollments, 'assignments' : assignments, 'submissions' : submissions, 'groups' : groups}
+
+# the submission filter input fields the stand-in knows about, per GraphQL input type; a filter using any other field is
+# rejected the way canvas rejects it. The course-level submissions connection takes SubmissionFilterInput and the
+# assignment-level one SubmissionSearchFilterInput (which has no graded/submitted since fields)
+SUBMISSION_FILTER_FIELDS = {'SubmissionFilterInput' : ['states', 'sectionIds', 'enrollmentTypes', 'submittedSince', 'gradedSince', 'updatedSince'],
+                            'SubmissionSearchFilterInput' : ['states', 'sectionIds', 'enrollmentTypes', 'userSearch', 'scoredLessThan',
+                                                             'scoredMoreThan', 'gradingStatus']}
+
+def filter_submissions(subms, student_ids = None, states = None, graded_since = None, submitted_since = None):
+    #timestamps are all ISO 8601 UTC strings, so they compare as strings
+    return [s for s in subms if (student_ids is None or str(s['user_id']) in student_ids)
+                                and (states is None or s['workflow_state'] in states)
+                                and (graded_since is None or (s['graded_at'] is not None and s['graded_at'] >= graded_since))
+                                and (submitted_since is None or (s['submitted_at'] is not None and s['submitted_at'] >= submitted_since))]
+
+class StandinHandler(BaseHTTPRequestHandler):
+    course = None
+    per_page = 100
+    n_requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def count(self):
+        with StandinHandler.lock:
+            StandinHandler.n_requests += 1
+            print('Requests served: ' + str(StandinHandler.n_requests) + ' (' + self.command + ' ' + self.path.split('?')[0] + ')', flush=True)
+
+    def send_json(self, data, links = None):
+        #like canvas, the ETag only covers the body (not the Link header)
+        body = json.dumps(data).encode('utf-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('X-Rate-Limit-Remaining', '700.0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('X-Rate-Limit-Remaining', '700.0')
+        if links:
+            self.send_header('Link', ','.join(['<' + url + '>; rel="' + rel + '"' for (rel, url) in links.items()]))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, items, query):
+        page = int(query.get('page', ['1'])[0])
+        n_pages = max(1, (len(items) + self.per_page - 1)//self.per_page)
+        base = 'http://' + self.headers['Host'] + self.path.split('?')[0] + '?'
+        def page_url(p):
+            return base + urllib.parse.urlencode(dict(query, page=[str(p)]), doseq=True)
+        links = {'current' : page_url(page), 'first' : page_url(1), 'last' : page_url(n_pages)}
+        if page < n_pages:
+            links['next'] = page_url(page+1)
+        self.send_json(items[(page-1)*self.per_page:page*self.per_page], links)
+
+    def do_GET(self):
+        self.count()
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        path = re.sub('^/api/v1/courses/[^/]+/?', '', parsed.path)
+        if path == '':
+            self.send_json(self.course['info'])
+        elif path == 'enrollments':
+            types = query.get('type[]')
+            self.send_page([e for e in self.course['enrollments'] if types is None or e['type'] in types], query)
+        elif path == 'assignments':
+            self.send_page(self.course['assignments'], query)
+        elif path == 'students/submissions':
+            aids = query.get('assignment_ids[]', list(self.course['submissions'].keys()))
+            self.send_page(filter_submissions([s for aid in aids for s in self.course['submissions'].get(aid, [])],
+                                              graded_since = query.get('graded_since', [None])[0],
+                                              submitted_since = query.get('submitted_since', [None])[0]), query)
+        elif path == 'groups':
+            self.send_page([{'id' : g['id'], 'name' : g['name'], 'members_count' : len(g['members'])} for g in self.course['groups']], query)
+        elif re.match('^/api/v1/groups/[0-9]+/memberships$', parsed.path):
+            gid = int(parsed.path.split('/')[-2])
+            self.send_page([{'user_id' : uid} for g in self.course['groups'] if g['id'] == gid for uid in g['members']], query)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.count()
+        if urllib.parse.urlparse(self.path).path != '/api/graphql':
+            self.send_error(404)
+            return
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        query, variables = req['query'], req.get('variables') or {}
+        start = int(variables.get('cursor') or 0)
+        if 'enrollmentsConnection' in query:
+            types = (variables.get('filter') or {}).get('types')
+            nodes = [{'_id' : str(e['id']), 'type' : e['type'], 'state' : e['enrollment_state'], 'createdAt' : e['created_at'],
+                      'updatedAt' : e['updated_at'], 'user' : {'_id' : str(e['user']['id']), 'name' : e['user']['name'],
+                      'sortableName' : e['user']['sortable_name'], 'shortName' : e['user']['short_name'], 'sisId' : e['user']['sis_user_id']}}
+                     for e in self.course['enrollments'] if types is None or e['type'] in types]
+            path = ['course', 'enrollmentsConnection']
+        elif 'submissionsConnection' in query:
+            #check the filter against the input type the connection takes, then apply it
+            path = ['assignment' if re.search(r'\bassignment\s*\(', query) else 'course', 'submissionsConnection']
+            expected = 'SubmissionSearchFilterInput' if path[0] == 'assignment' else 'SubmissionFilterInput'
+            declared = re.search(r'\$filter\s*:\s*(\w+)', query)
+            filt = variables.get('filter') or {}
+            if declared is not None and declared.group(1) != expected:
+                self.send_json({'errors' : [{'message' : 'Type mismatch on variable $filter and argument filter (' + declared.group(1) + ' / ' + expected + ')'}]})
+                return
+            unknown = [key for key in filt if key not in SUBMISSION_FILTER_FIELDS[expected]]
+            if len(unknown) > 0:
+                self.send_json({'errors' : [{'message' : 'Variable $filter of type ' + expected + ' was provided invalid value for ' +
+                                                         ', '.join(unknown) + ' (Field is not defined on ' + expected + ')'}]})
+                return
+            if path[0] == 'assignment':
+                subms = self.course['submissions'].get(variables['assignmentId'], [])
+            else:
+                subms = [s for aid in self.course['submissions'] for s in self.course['submissions'][aid]]
+            student_ids = variables.get('studentIds')
+            subms = filter_submissions(subms, None if student_ids is None else set(student_ids), filt.get('states'),
+                                       filt.get('gradedSince'), filt.get('submittedSince'))
+            nodes = [{'assignment' : {'_id' : str(s['assignment_id'])}, 'userId' : str(s['user_id']), 'grade' : s['grade'], 'score' : s['score'],
+                      'state' : s['workflow_state'], 'excused' : s['excused'], 'latePolicyStatus' : s['late_policy_status'],
+                      'deductedPoints' : s['points_deducted'], 'postedAt' : s['posted_at'], 'late' : s['late'], 'missing' : s['missing'],
+                      'enteredGrade' : s['entered_grade'], 'enteredScore' : s['entered_score']} for s in subms]
+        elif 'groupsConnection' in query:
+            nodes = [{'_id' : str(g['id']), 'name' : g['name'], 'membersConnection' : {'nodes' : [{'user' : {'_id' : str(uid)}} for uid in g['members'][:100]],
+                      'pageInfo' : {'hasNextPage' : len(g['members']) > 100}}} for g in self.course['groups']]
+            path = ['course', 'groupsConnection']
+        else:
+            self.send_json({'errors' : [{'message' : 'unsupported query in stand-in server'}]})
+            return
+        conn = {'nodes' : nodes[start:start+self.per_page],
+                'pageInfo' : {'hasNextPage' : start + self.per_page < len(nodes), 'endCursor' : str(start + self.per_page)}}
+        self.send_json({'data' : {path[0] : {path[1] : conn}}})
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a synthetic course through a stand-in for the Canvas REST/GraphQL APIs.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--students', type=int, default=1500)
+    parser.add_argument('--assignments', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=300)
+    parser.add_argument('--hub-root', dest='hub_root', default='hub.example.com')
+    args = parser.parse_args()
+    StandinHandler.course = make_course(args.students, args.assignments, args.groups, args.hub_root)
+    print('Serving stand-in canvas course on port ' + str(args.port))
+    ThreadingHTTPServer(('', args.port), StandinHandler).serve_forever()
@@ -4,11 +4,26 @@ c.name = 'dsci100'
 c.canvas_domain = 'https://canvas.ubc.ca'
 c.canvas_id = '12345' #course number from the canvas URL
 c.canvas_token = '23487~sdfasdfga3847fga874fga8347fgaf' #canvas API token (this example was generated by the ISmashedMyKeyboard algorithm)
+#c.canvas_backend = 'rest' #'rest', or 'graphql' to obtain enrollments, submissions and groups through batched GraphQL queries
+#c.canvas_graphql_chunk_students = 100 #with the graphql backend, full submission fetches for more students than this are split into concurrently fetched chunks (of at least this many students)
+#c.canvas_max_workers = 8 #max number of concurrent requests / pooled connections used when paging through canvas collections
+#c.canvas_max_retries = 5 #number of times to retry canvas requests that were throttled or hit a transient error (with jittered exponential backoff)
+#c.group_cache_max_age_hours = 24 #group memberships are cached in the state database and refetched when a group changes or its cache entry is older than this
+#c.canvas_http_cache = True #cache canvas GET responses on disk (in <name>_http_cache/) and revalidate them with conditional requests
+#c.canvas_http_cache_max_mb = 200 #max size of the http cache; least recently used entries are evicted first
+#c.canvas_http_cache_max_age_days = 7 #http cache entries unused for this long are evicted
+#c.canvas_delta_sync = True #keep processed canvas state between runs (in the <name>_state.db state database) and only reprocess/refetch what changed
 c.user_folder_root = '/tank/home/dsci100' #the root folder for users on *both* student and instructor jupyterhub servers
 c.student_local_assignment_folder = 'dsci-100/materials' # the name of the student repository and the subdirectory in the students repository where assignments are stored (if it is used)
 c.grading_image = 'yourdockeraccount/your-docker-image:v0.1'
 c.jupyterhub_host_root = 'your-student-jupyterhub.domain.com'
 c.jupyterhub_config_dir = '/srv/jupyterhub/' #the folder where jupyterhub_config and zfs_homedir.sh is
+#c.storage_backend = 'zfs' #'zfs', or 'fake' to emulate datasets/snapshots with plain directories under user_folder_root (for testing/benchmarking without a zfs pool)
+#c.fake_zfs_copy_mode = 'hardlink' #how the fake backend copies files into snapshots: 'hardlink', or 'copy' (cp --reflink=auto)
+#c.zfs_dataset_options = {'refquota' : '2G'} #zfs properties for the grader template datasets and grader clones rudaux creates (keep in line with ZFSOPTS in zfs_homedir.sh)
+#c.clone_grader_folders = False #build each assignment's grader folder once (as a zfs dataset rudaux-template-<assignment>) and create grader folders as zfs clones of it
+#c.snapshot_retention_days = 14 #rudaux prune never destroys snapshots younger than this
+#c.snapshot_retention_require_posted = False #if True, rudaux prune keeps a student's snapshots until their grade is posted (not just uploaded)
 c.latereg_extension_days = 7 #number of days to give extensions for late registrations (registration date + 7 days here)
 c.instructor_user = 'your_username' #your username on the jupyterhub (you have to create this using dictauth)
 c.instructor_repo_url = 'git@github.com:your-account/your-repo.git' #the git url for the course material